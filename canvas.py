@@ -4,7 +4,7 @@ from PyQt5 import QtWidgets
 from PyQt5 import QtGui
 from PyQt5 import QtCore
 
-from datatypes import Annotation
+from datatypes import Annotation, AnnotationIndex
 import utils
 
 # - [maybe] Find optimal epsilon value.
@@ -51,7 +51,8 @@ class Canvas(QtWidgets.QWidget):
         ################################################################################
         # 支持图像存储和显示
         ################################################################################
-        self.pixmap = QtGui.QPixmap()
+        # 当前图像,为直接引用窗位窗宽渲染结果的QImage,绘制时不需要再转换为QPixmap
+        self.pixmap = QtGui.QImage()
         ################################################################################
         # 支持模式提示图标绘制
         ################################################################################
@@ -80,6 +81,13 @@ class Canvas(QtWidgets.QWidget):
         self.annotations = []
         # 标记列表的备份
         self.annotataions_backups = []
+        # 被撤销的备份，用于重做
+        self.annotations_redo_backups = []
+        # 标记的空间索引，悬停检测和点选只检查光标附近的标记，在查询前与标记列表同步
+        self.annotation_index = AnnotationIndex()
+        # 未选中且未高亮的标记预先绘制在离屏的覆盖层上，覆盖层及其对应的状态
+        self._overlay = None
+        self._overlay_key = None
         ################################################################################
         # 支持标记选择，用in方法查询
         ################################################################################
@@ -164,7 +172,7 @@ class Canvas(QtWidgets.QWidget):
                 self.finalise_current_annotation()
             else:
                 self.current_annotation = None
-                self.repaint()
+                self.update()
         self._create_mode = value
         self.mode_icon_timer.start(25)
 
@@ -187,16 +195,28 @@ class Canvas(QtWidgets.QWidget):
     ################################################################################
     # 支持撤销操作
     ################################################################################
-    # 将最近的的10个标记列表（最近的10个标记状态）备份
+    # 备份标记列表的状态，最多保留MAX_BACKUPS个，最后一个备份是当前状态
+    # 备份由各标记的快照组成，未变化的标记在备份之间共享同一个快照，
+    #   每次备份的代价只与发生变化的标记有关，而不需要深复制所有标记
+    MAX_BACKUPS = 10
+
     def store_annotations(self):
         # print('store annotations')
-        annotations_backup = []
-        for annotation in self.annotations:
-            # insight: 进行备份时要使用copy方法
-            annotations_backup.append(annotation.copy())
-        if len(self.annotataions_backups) >= 10:
-            self.annotataions_backups = self.annotataions_backups[-9:]
+        annotations_backup = tuple((annotation, annotation.memento()) for annotation in self.annotations)
+        # 状态没有变化时不重复备份
+        if self.annotataions_backups and self.is_same_backup(self.annotataions_backups[-1], annotations_backup):
+            return
+        if len(self.annotataions_backups) >= self.MAX_BACKUPS:
+            self.annotataions_backups = self.annotataions_backups[-(self.MAX_BACKUPS - 1):]
         self.annotataions_backups.append(annotations_backup)
+        # 新的修改使被撤销的状态不能再被重做
+        self.annotations_redo_backups = []
+
+    @staticmethod
+    def is_same_backup(backup1, backup2):
+        return len(backup1) == len(backup2) and all(
+            annotation1 is annotation2 and memento1 is memento2
+            for (annotation1, memento1), (annotation2, memento2) in zip(backup1, backup2))
 
     # 当标记备份中的标记列表多于一个，标记状态是可恢复的
     @property
@@ -205,16 +225,30 @@ class Canvas(QtWidgets.QWidget):
             return False
         return True
 
-    # 从标记备份中取出一个标记列表，覆盖当前列表，重绘canvas，完成恢复
+    # 撤销：当前状态移入重做列表，恢复到上一个备份，重绘canvas，完成恢复
     def restore_annotations(self):
         if not self.is_annotations_restoreable:
             return
-        self.annotataions_backups.pop()
-        annotations_backup = self.annotataions_backups.pop()
+        self.annotations_redo_backups.append(self.annotataions_backups.pop())
+        self.apply_annotations_backup(self.annotataions_backups[-1])
+
+    # 重做：恢复到最近一次被撤销的状态
+    def redo_annotations(self):
+        if not self.annotations_redo_backups:
+            return
+        annotations_backup = self.annotations_redo_backups.pop()
+        self.annotataions_backups.append(annotations_backup)
+        self.apply_annotations_backup(annotations_backup)
+
+    def apply_annotations_backup(self, annotations_backup):
+        # 将每个标记恢复到备份中的快照，未变化的标记保持不变
+        for annotation, memento in annotations_backup:
+            annotation.restore(memento)
         # 恢复标记列表
-        self.annotations = annotations_backup
+        self.annotations = [annotation for annotation, _ in annotations_backup]
         self.selected_annotations = []
-        self.repaint()
+        self.annotations_changed_signal.emit(self.annotations)
+        self.update()
 
     # TODO: last_point, last_line的命名和功能划分令人迷惑，进行优化
     # 撤销最后一个被创建标记的最后一个点
@@ -231,7 +265,7 @@ class Canvas(QtWidgets.QWidget):
         elif self.create_type == 'point':
             self.current_annotation = None
         self.is_canvas_creating_signal.emit(bool(self.current_annotation))
-        self.repaint()
+        self.update()
 
     # 撤销当前被创建标记的最后一个点
     def undo_last_point(self):
@@ -243,7 +277,7 @@ class Canvas(QtWidgets.QWidget):
         else:
             self.current_annotation = None
             self.is_canvas_creating_signal.emit(False)
-        self.repaint()
+        self.update()
 
     def undo(self):
         '''根据当前canvas状态决定撤销操作应当如何被理解'''
@@ -287,6 +321,7 @@ class Canvas(QtWidgets.QWidget):
     # 完成当前标记的创建，不再增加点
     def finalise_current_annotation(self):
         assert self.current_annotation
+        self.current_annotation.clear_highlight_vertex()
         self.current_annotation.close()
         self.annotations.append(self.current_annotation)
         self.annotation_created_signal.emit(self.current_annotation)
@@ -388,7 +423,7 @@ class Canvas(QtWidgets.QWidget):
         self.store_annotations()
         self.annotations_changed_signal.emit(self.annotations)
         self.selected_annotations_copy = []
-        self.repaint()
+        self.update()
         self.store_annotations()
         return True
 
@@ -442,7 +477,8 @@ class Canvas(QtWidgets.QWidget):
             return
         # 如果没有，将鼠标点击的标记置于选中状态，用于在画布上选择标记
         # 将选择包含光标的，最后被创建的标记，支持单选和复选
-        for annotation in reversed(self.annotations):
+        self.annotation_index.sync(self.annotations)
+        for annotation in self.annotation_index.query(point):
             if annotation.is_visable and annotation.containsPoint(point):
                 # 成功进行选中则重新计算offsets_to_bounding_rect
                 self.calculate_offsets_to_bounding_rect(annotation, point)
@@ -512,6 +548,10 @@ class Canvas(QtWidgets.QWidget):
             self.override_cursor(CURSOR_DRAW)
             if self.current_annotation is None:
                 return
+            # 记录变化前的区域，只重绘正在创建的标记变化前后覆盖的区域
+            dirty_rect = self.annotations_rect([self.current_annotation, self.virtual_annotation])
+            # 起点的高亮只在光标足够接近时保持，每次移动时重新判断
+            self.current_annotation.clear_highlight_vertex()
             color = self.line_color
             # 处理出界点
             if self.is_out_of_pixmap(pos):
@@ -536,9 +576,7 @@ class Canvas(QtWidgets.QWidget):
             elif self.create_type == 'point':
                 self.virtual_annotation.points = [self.current_annotation[0]]
             self.virtual_annotation.line_color = color
-            # question: 创建模式下每次mouseMoveEvent都repaint合理吗？
-            self.repaint()
-            self.current_annotation.clear_highlight_vertex()
+            self.update_annotations([self.current_annotation, self.virtual_annotation], dirty_rect)
             return
 
         # 编辑模式下
@@ -548,26 +586,29 @@ class Canvas(QtWidgets.QWidget):
                 # 若已经创建副本，移动被选中标记的副本
                 if self.selected_annotations_copy and self.prev_recorded_point:
                     self.override_cursor(CURSOR_MOVE)
+                    dirty_rect = self.annotations_rect(self.selected_annotations_copy)
                     self.move_annotations(self.selected_annotations_copy, pos)
-                    self.repaint()
+                    self.update_annotations(self.selected_annotations_copy, dirty_rect)
                 # 若还没有创建副本，创建被选中标记的副本
                 elif self.selected_annotations:
                     self.selected_annotations_copy = \
                         [selected_annotation.copy() for
                          selected_annotation in self.selected_annotations]
-                    self.repaint()
+                    self.update_annotations(self.selected_annotations_copy)
                 return
 
             # 按住左键移动进行标记/顶点的移动
             if QtCore.Qt.LeftButton & ev.buttons():
                 if self.hVertex is not None:
+                    dirty_rect = self.annotations_rect([self.hShape])
                     self.move_vertex(pos)
-                    self.repaint()
+                    self.update_annotations([self.hShape], dirty_rect)
                     self.is_moving_annotations = True
                 elif self.selected_annotations and self.prev_recorded_point:
                     self.override_cursor(CURSOR_MOVE)
+                    dirty_rect = self.annotations_rect(self.selected_annotations)
                     self.move_annotations(self.selected_annotations, pos)
-                    self.repaint()
+                    self.update_annotations(self.selected_annotations, dirty_rect)
                     self.is_moving_annotations = True
                 return
             # 左右键都没被按下，鼠标移动带来高亮状态的变化，具体来说
@@ -575,8 +616,12 @@ class Canvas(QtWidgets.QWidget):
             # 对于每个标记，尝试找到一个足够近的顶点作为高亮顶点，
             # 若没有，若标记包含光标，则选择标记为高亮形状，最近且足够近的边为高亮边（没有足够近的边则为None）
             # 逻辑上，对顶点的高亮优先于形状的高亮，而每一个后被创建的标记的高亮，会覆盖（因此优先于）前一个标记的高亮
-            for annotation in reversed(
-                    [anno for anno in self.annotations if anno.is_visable]):
+            # 只有包围盒(扩展epsilon)包含光标的标记才可能被高亮，通过空间索引找出这些标记，后创建的在前
+            # 高亮状态只影响原先和新的高亮标记，只重绘这两个标记覆盖的区域
+            dirty_rect = self.annotations_rect([self.hShape])
+            self.annotation_index.sync(self.annotations)
+            for annotation in [anno for anno in self.annotation_index.query(pos, self.epsilon / self.scale)
+                               if anno.is_visable]:
                 index = annotation.get_nearest_vertex(pos, self.epsilon / self.scale)
                 index_edge = annotation.get_nearest_edge(pos, self.epsilon / self.scale)
                 # 如果能找到足够近的点，刷新高亮顶点
@@ -589,7 +634,7 @@ class Canvas(QtWidgets.QWidget):
                     # 高亮类型是MOVE_VERTEX,高亮类型决定了这个顶点将如何被绘制
                     annotation.highlight_vertex(index, annotation.MOVE_VERTEX)
                     self.override_cursor(CURSOR_POINT)
-                    self.update()
+                    self.update_annotations([annotation], dirty_rect)
                     break
                 elif annotation.containsPoint(pos):
                     if self.hVertex is not None:
@@ -598,7 +643,7 @@ class Canvas(QtWidgets.QWidget):
                     self.hShape = annotation
                     self.hEdge = index_edge
                     self.override_cursor(CURSOR_GRAB)
-                    self.update()
+                    self.update_annotations([annotation], dirty_rect)
                     break
             # insight: 注意！此处采用了python的for-else结构
             #   在for循环执行的过程中，如果break被执行了，则不会执行else
@@ -610,7 +655,7 @@ class Canvas(QtWidgets.QWidget):
             else:
                 if self.hShape:
                     self.hShape.clear_highlight_vertex()
-                    self.update()
+                    self.update_annotations([], dirty_rect)
                 self.hVertex, self.hShape, self.hEdge = None, None, None
             # 通过光标重绘说明add_point_to_nearest_edge的可用性
             if self.hEdge and not self.hVertex:
@@ -656,14 +701,14 @@ class Canvas(QtWidgets.QWidget):
                 # 当顶点的添加可用,且顶点的选择不可用时,进行顶点的添加
                 if self.hEdge and not self.hVertex:
                     self.add_point_to_nearest_edge()
-                    self.repaint()
+                    self.update()
                     return
                 # 否则进行顶点或标记的选择
                 group_mode = (int(ev.modifiers()) == QtCore.Qt.ControlModifier)
                 self.select_pointed_vertex_or_annotation(pos,
                                                          multiple_selection_mode=group_mode)
                 self.prev_recorded_point = pos
-                self.repaint()
+                self.update()
         # question: 考虑右键选中的利弊
         #   pros: 在进行copy-moving和呼出菜单处理选中标记时不需要先用左键选中，更加连贯
         #   cons: 在想要呼出菜单时只要进行移动就会触发copy-moving，很容易误操作
@@ -675,7 +720,7 @@ class Canvas(QtWidgets.QWidget):
         #     self.select_pointed_vertex_or_annotation(pos,
         #                                              multiple_selection_mode=group_mode)
         #     self.prev_recorded_point = pos
-        #     self.repaint()
+        #     self.update()
 
     # 鼠标松开事件
     def mouseReleaseEvent(self, ev):
@@ -833,11 +878,12 @@ class Canvas(QtWidgets.QWidget):
         self.pixmap = pixmap
         self.annotations = []
         self.annotataions_backups = []
+        self.annotations_redo_backups = []
         self.selected_annotations = []
         self.hShape = None
         self.hVertex = None
         self.hEdge = None
-        self.repaint()
+        self.update()
 
     def load_annotations(self, annotations, replace=True):
         if replace:
@@ -846,11 +892,94 @@ class Canvas(QtWidgets.QWidget):
             self.annotations.extend(annotations)
         self.store_annotations()
         self.current_annotation = None
-        self.repaint()
+        self.update()
 
     ################################################################################
     # 支持canvas中一切的绘制，请仔细了解数据池中各个要素被绘制的逻辑
     ################################################################################
+    ################################################################################
+    # 支持局部重绘，只重绘发生变化的标记所覆盖的区域，由Qt合并多次重绘请求
+    ################################################################################
+    def annotation_rect(self, annotation):
+        '''返回标记在控件坐标系中覆盖的区域，包括顶点标志和线宽'''
+        if annotation is None or not annotation.points:
+            return QtCore.QRect()
+        rect = annotation.boundingRect()
+        offset = self.caculate_offset_to_center()
+        s = self.scale
+        rect = QtCore.QRectF((rect.left() + offset.x()) * s, (rect.top() + offset.y()) * s,
+                             rect.width() * s, rect.height() * s).normalized().toAlignedRect()
+        # 顶点标志的半径最大为高亮时的2倍point_size，再留出线宽与抗锯齿的余量
+        margin = Annotation.point_size * 2 + 4
+        return rect.adjusted(-margin, -margin, margin, margin)
+
+    def annotations_rect(self, annotations):
+        '''返回多个标记覆盖区域的并集'''
+        rect = QtCore.QRect()
+        for annotation in annotations:
+            rect = rect.united(self.annotation_rect(annotation))
+        return rect
+
+    def update_annotations(self, annotations, dirty_rect=None):
+        '''重绘标记当前覆盖的区域与dirty_rect(通常为变化前覆盖的区域)的并集'''
+        rect = self.annotations_rect(annotations)
+        if dirty_rect is not None:
+            rect = rect.united(dirty_rect)
+        if not rect.isEmpty():
+            self.update(rect)
+
+    def mode_icon_rect(self):
+        '''返回模式提示图标在控件坐标系中的区域'''
+        offset = self.caculate_offset_to_center()
+        size = self.create_mode_icon.size().expandedTo(self.edit_mode_icon.size())
+        return QtCore.QRectF(offset.x() * self.scale, offset.y() * self.scale,
+                             size.width() * self.scale, size.height() * self.scale).toAlignedRect()
+
+    ################################################################################
+    # 支持标记覆盖层，未选中且未高亮的标记只在其状态、选择或缩放变化时重新绘制
+    ################################################################################
+    # 覆盖层的最大像素数，放大到超过此尺寸时直接绘制标记，避免占用过多内存
+    MAX_OVERLAY_PIXELS = 4096 * 4096
+
+    def is_live_annotation(self, annotation):
+        '''选中和高亮的标记在每次重绘时绘制，不进入覆盖层'''
+        return annotation in self.selected_annotations or annotation is self.hShape
+
+    def annotation_overlay(self):
+        '''
+        返回绘制了所有未选中且未高亮的可见标记的覆盖层，覆盖整个控件，状态未变化时直接返回缓存
+        覆盖层按设备像素创建，在高分屏上与直接绘制同样清晰
+        '''
+        size = super(Canvas, self).size()
+        ratio = self.devicePixelRatioF()
+        if size.width() * size.height() * ratio * ratio > self.MAX_OVERLAY_PIXELS:
+            self._overlay, self._overlay_key = None, None
+            return None
+        offset = self.caculate_offset_to_center()
+        annotations = [annotation for annotation in self.annotations
+                       if annotation.is_visable and not self.is_live_annotation(annotation)]
+        key = (self.scale, size.width(), size.height(), ratio, offset.x(), offset.y(),
+               Annotation.point_size, Annotation.point_type,
+               tuple((id(annotation), annotation.geometry_version, annotation.isClosed(),
+                      annotation._highlightIndex, annotation.line_color.rgba(), annotation.vertex_fill_color.rgba())
+                     for annotation in annotations))
+        if key != self._overlay_key:
+            overlay = QtGui.QPixmap(size * ratio)
+            overlay.setDevicePixelRatio(ratio)
+            overlay.fill(QtCore.Qt.transparent)
+            p = QtGui.QPainter(overlay)
+            p.setRenderHint(QtGui.QPainter.Antialiasing)
+            p.setRenderHint(QtGui.QPainter.HighQualityAntialiasing)
+            p.scale(self.scale, self.scale)
+            p.translate(offset)
+            Annotation.scale = self.scale
+            for annotation in annotations:
+                annotation.fill = False
+                annotation.paint(p)
+            p.end()
+            self._overlay, self._overlay_key = overlay, key
+        return self._overlay
+
     def paintEvent(self, event):
         if not self.pixmap:
             return super(Canvas, self).paintEvent(event)
@@ -865,13 +994,24 @@ class Canvas(QtWidgets.QWidget):
         p.scale(self.scale, self.scale)
         p.translate(self.caculate_offset_to_center())
         # 绘制图像
-        p.drawPixmap(0, 0, self.pixmap)
+        p.drawImage(0, 0, self.pixmap)
 
         Annotation.scale = self.scale
         # 标记的绘制
         # 处理绘制完成的标记
-        for annotation in self.annotations:
-            if annotation.is_visable:
+        #   未选中且未高亮的标记直接绘制缓存的覆盖层，只有选中和高亮的标记在每次重绘时绘制
+        #   局部重绘时跳过不在重绘区域内的标记
+        dirty_rect = event.rect()
+        live_annotations = self.annotations
+        overlay = self.annotation_overlay()
+        if overlay is not None:
+            p.save()
+            p.resetTransform()
+            p.drawPixmap(0, 0, overlay)
+            p.restore()
+            live_annotations = [annotation for annotation in self.annotations if self.is_live_annotation(annotation)]
+        for annotation in live_annotations:
+            if annotation.is_visable and self.annotation_rect(annotation).intersects(dirty_rect):
                 annotation.fill = (
                                           annotation in self.selected_annotations) or annotation == self.hShape
                 annotation.paint(p, selected=(
@@ -915,7 +1055,7 @@ class Canvas(QtWidgets.QWidget):
             if self.mode_icon_opacity <= 0.0:
                 self.has_reached_mode_icon_opacity_peak = False
                 self.mode_icon_timer.stop()
-        self.repaint()
+        self.update(self.mode_icon_rect())
 
     ################################################################################
     # 标记可见性修改
@@ -925,9 +1065,10 @@ class Canvas(QtWidgets.QWidget):
         for annotation in self.selected_annotations:
             annotation.is_visable = value
         self.annotations_visibility_changed_signal.emit()
+        dirty_rect = self.annotations_rect(self.selected_annotations)
         self.selected_annotations = []
         self.store_annotations()
-        self.repaint()
+        self.update_annotations([], dirty_rect)
 
     def set_all_annotations_visibility(self, value: bool) -> None:
         '''修改所有标记的可见性'''
@@ -936,12 +1077,13 @@ class Canvas(QtWidgets.QWidget):
         self.annotations_visibility_changed_signal.emit()
         self.selected_annotations = []
         self.store_annotations()
-        self.repaint()
+        self.update()
 
     def resetState(self):
         self.restore_cursor()
         self.pixmap = None
         self.annotataions_backups = []
+        self.annotations_redo_backups = []
         self.update()
 
 if __name__ == '__main__':
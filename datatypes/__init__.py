@@ -1,3 +1,7 @@
 from .dicom_tree import DicomTree
+from .database_store import DatabaseStore
 from .label_struct import LabelStruct
-from .annotations import Annotation
\ No newline at end of file
+from .annotations import Annotation
+from .annotation_index import AnnotationIndex
+from .annotation_file import read_annotations, write_annotations, find_legacy_annotations, read_legacy_annotations
+from .annotation_container import AnnotationContainer, container_path
\ No newline at end of file
@@ -0,0 +1,243 @@
+'''
+实现序列级的标记容器(.anc)，一个序列的所有切片的标记保存在同一个文件中，代替每张切片一个标记文件
+容器位于序列的dicom文件所在目录，以series uid命名，按instance uid随机访问各切片的标记
+文件格式(小端序)
+    文件头: 魔数b'DCMS', uint16版本号
+    之后是若干条记录，保存一张切片时在文件末尾追加一条，不修改已有的内容:
+        uint16 instance uid长度, uint32数据长度, uint32校验值(crc32, 覆盖uid与数据)
+        ascii编码的instance uid
+        该切片的全部标记，格式与.ann文件相同(见annotation_file)，长度为0表示切片上没有标记
+同一个instance uid以最后一条记录为准，被覆盖的记录累积到一定比例时重写整个容器以回收空间
+追加中途出错只会在末尾留下不完整或校验失败的记录，读取时丢弃，下一次追加之前截断
+原有的每张切片一个的标记文件可以转换到容器中: python -m datatypes.annotation_container 目录 [--remove]
+'''
+
+import os
+import os.path as osp
+import struct
+import threading
+import zlib
+
+from .annotations import Annotation
+from .annotation_file import dumps_annotations, loads_annotations, find_legacy_annotations, read_legacy_annotations, \
+    LEGACY_EXTENSIONS
+
+from typing import Dict, List, Tuple
+
+MAGIC = b'DCMS'
+VERSION = 1
+EXTENSION = '.anc'
+
+HEADER = struct.Struct('<4sH')
+RECORD = struct.Struct('<HII')
+
+def container_path(dicom_path: str, series_uid: str) -> str:
+    '''返回dicom文件所属序列的标记容器路径'''
+    return osp.join(osp.dirname(dicom_path), series_uid + EXTENSION)
+
+
+class AnnotationContainer(object):
+    '''
+    一个序列的标记容器
+    打开时顺序读取一次整个文件，建立instance uid到记录位置的索引，之后读取单张切片只需一次定位读取
+    读写都在lock中进行，可以在后台线程中写入的同时在界面线程中读取
+    verify为False时只读取每条记录的头部，跳过数据与校验，用于快速查询哪些切片有标记，这样打开的容器不能用于写入
+    '''
+
+    # 被覆盖的记录超过文件大小的这一比例时，追加后重写容器
+    COMPACT_RATIO = 0.5
+    # 文件小于这一大小(字节)时不重写
+    COMPACT_MIN_SIZE = 1 << 20
+
+    def __init__(self, path: str, verify: bool = True):
+        self.path = path
+        self.verify = verify
+        # instance uid -> (数据在文件中的偏移, 数据长度)
+        self.index = {}  # type: Dict[str, Tuple[int, int]]
+        # 有效内容的大小，其后是追加中途出错留下的不完整记录
+        self.size = 0
+        # 被后续记录覆盖的记录所占的字节数
+        self.garbage = 0
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self) -> None:
+        self.index.clear()
+        self.size = self.garbage = 0
+        if not osp.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read(HEADER.size)
+            if len(data) < HEADER.size:
+                return
+            magic, version = HEADER.unpack_from(data, 0)
+            if magic != MAGIC:
+                raise ValueError('不是标记容器: %s' % self.path)
+            if version > VERSION:
+                raise ValueError('不支持的标记容器版本: %d' % version)
+            if not self.verify:
+                self.size = self.load_headers(f)
+                return
+            data += f.read()
+        offset = HEADER.size
+        while offset + RECORD.size <= len(data):
+            uid_length, data_length, checksum = RECORD.unpack_from(data, offset)
+            start = offset + RECORD.size
+            end = start + uid_length + data_length
+            if end > len(data) or zlib.crc32(data[start:end]) != checksum:
+                break
+            uid = data[start:start + uid_length].decode('ascii')
+            self._index_record(uid, start + uid_length, data_length)
+            offset = end
+        self.size = offset
+
+    def load_headers(self, f) -> int:
+        '''只读取每条记录的头部与uid，跳过数据，返回有效内容的大小'''
+        file_size = os.fstat(f.fileno()).st_size
+        offset = HEADER.size
+        while offset + RECORD.size <= file_size:
+            f.seek(offset)
+            uid_length, data_length, checksum = RECORD.unpack(f.read(RECORD.size))
+            start = offset + RECORD.size
+            end = start + uid_length + data_length
+            if end > file_size:
+                break
+            try:
+                uid = f.read(uid_length).decode('ascii')
+            except UnicodeDecodeError:
+                break
+            self._index_record(uid, start + uid_length, data_length)
+            offset = end
+        return offset
+
+    def _index_record(self, uid: str, offset: int, length: int) -> None:
+        previous = self.index.get(uid)
+        if previous is not None:
+            self.garbage += RECORD.size + len(uid) + previous[1]
+        self.index[uid] = (offset, length)
+
+    def __contains__(self, uid: str) -> bool:
+        '''切片上是否有标记'''
+        entry = self.index.get(uid)
+        return entry is not None and entry[1] > 0
+
+    @property
+    def annotated(self) -> bool:
+        '''序列中是否有切片带有标记'''
+        return any(length > 0 for offset, length in self.index.values())
+
+    def read(self, uid: str) -> List[Annotation]:
+        '''读取一张切片的标记，没有标记时返回空列表'''
+        with self.lock:
+            offset, length = self.index.get(uid, (0, 0))
+            if not length:
+                return []
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+        return loads_annotations(data)
+
+    def write(self, uid: str, annotations: List[Annotation]) -> None:
+        '''追加一张切片的标记，annotations为空时记录该切片的标记已被清空'''
+        self.update({uid: annotations})
+
+    def update(self, annotations_dict: Dict[str, List[Annotation]]) -> None:
+        '''在一次追加中写入多张切片的标记，形式为{instance uid: 标记列表}'''
+        records = [(uid, dumps_annotations(annotations) if annotations else b'')
+                   for uid, annotations in annotations_dict.items()
+                   if annotations or uid in self]
+        if not records:
+            return
+        if not self.verify:
+            raise ValueError('未校验的标记容器不能用于写入: %s' % self.path)
+        with self.lock:
+            self.append(records)
+            if self.size >= self.COMPACT_MIN_SIZE and self.garbage > self.size * self.COMPACT_RATIO:
+                self.compact()
+
+    def append(self, records: List[Tuple[str, bytes]]) -> None:
+        with open(self.path, 'r+b' if osp.exists(self.path) else 'wb') as f:
+            # 打开容器之后其他进程(另一个程序实例、migrate_dir或共享目录中的其他用户)可能追加或重写了容器，
+            # 文件大小与索引不一致时重新建立索引，之后只截断校验失败的末尾，不丢弃尚未读取的有效记录
+            if os.fstat(f.fileno()).st_size != self.size:
+                self.load()
+            if self.size == 0:
+                f.truncate(0)
+                f.write(HEADER.pack(MAGIC, VERSION))
+                self.size = HEADER.size
+            else:
+                # 丢弃上一次追加中途出错留下的不完整记录
+                f.truncate(self.size)
+                f.seek(self.size)
+            for uid, data in records:
+                uid_bytes = uid.encode('ascii')
+                f.write(RECORD.pack(len(uid_bytes), len(data), zlib.crc32(uid_bytes + data)))
+                f.write(uid_bytes)
+                f.write(data)
+                self._index_record(uid, self.size + RECORD.size + len(uid_bytes), len(data))
+                self.size += RECORD.size + len(uid_bytes) + len(data)
+
+    def compact(self) -> None:
+        '''只保留每张切片最新的非空记录，写入临时文件后替换原容器'''
+        with open(self.path, 'rb') as f:
+            records = []
+            for uid, (offset, length) in self.index.items():
+                if length:
+                    f.seek(offset)
+                    records.append((uid, f.read(length)))
+        path = self.path
+        self.path = path + '.tmp'
+        # 清空上一次重写失败留下的临时文件，否则追加前会按其中的内容建立索引
+        open(self.path, 'wb').close()
+        self.index.clear()
+        self.size = self.garbage = 0
+        try:
+            self.append(records)
+            os.replace(path + '.tmp', path)
+        finally:
+            self.path = path
+            # 重写失败时原容器保持不变，按原容器重新建立索引
+            if osp.exists(path + '.tmp'):
+                self.load()
+
+
+def migrate_dir(dir: str, remove: bool = False) -> int:
+    '''
+    递归地将目录中原有的每张切片一个的标记文件(.pkl或.ann)写入所属序列的标记容器，返回转换的切片数
+    标记文件与同名的dicom文件对应，序列和切片由dicom文件头中的uid确定
+    '''
+    import pydicom
+
+    count = 0
+    for root, dirs, files in os.walk(dir):
+        containers = {}
+        names = set(files)
+        for file in files:
+            stem, extension = osp.splitext(file)
+            if extension.lower() != '.dcm' or not any(stem + legacy in names for legacy in LEGACY_EXTENSIONS):
+                continue
+            dicom_path = osp.join(root, file)
+            # .ann与.pkl都存在时以较新的一个为准
+            legacy_path = find_legacy_annotations(dicom_path)
+            header = pydicom.dcmread(dicom_path, stop_before_pixels=True,
+                                     specific_tags=[(0x0008, 0x0018), (0x0020, 0x000E)])
+            path = container_path(dicom_path, header[0x0020, 0x000E].value)
+            if path not in containers:
+                containers[path] = AnnotationContainer(path)
+            uid = header[0x0008, 0x0018].value
+            # 容器中已有的记录是在程序中保存的，比原有的标记文件新，不能被覆盖
+            if uid in containers[path].index:
+                continue
+            containers[path].write(uid, read_legacy_annotations(legacy_path))
+            if remove:
+                for legacy in LEGACY_EXTENSIONS:
+                    if stem + legacy in names:
+                        os.remove(osp.join(root, stem + legacy))
+            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    import sys
+
+    print('转换了%d个标记文件' % migrate_dir(sys.argv[1], '--remove' in sys.argv[2:]))
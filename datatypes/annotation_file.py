@@ -0,0 +1,152 @@
+'''
+实现标记文件(.ann)的读写，代替原先对Annotation对象列表的pickle
+文件格式(小端序)，版本号变化时读取方可以据此兼容或拒绝
+    文件头: 魔数b'DCMA', uint16版本号, uint32标记数
+    每个标记:
+        uint8类型(ANNOTATION_TYPES中的序号), uint8标志位, uint32顶点数, uint32标签长度
+        [uint32边框颜色rgba, 仅当标志位中有HAS_LINE_COLOR时]
+        [uint32填充颜色rgba, 仅当标志位中有HAS_FILL_COLOR时(版本2)]
+        float32顶点坐标数组 x0, y0, x1, y1, ...
+        utf-8编码的标签字典(json)
+读取时只解析数据，不会像pickle那样执行文件中的任意代码
+标记保存在序列级的标记容器中，这一格式作为容器中每张切片的数据，见annotation_container
+'''
+
+import io
+import json
+import os
+import os.path as osp
+import pickle
+import struct
+
+import numpy as np
+
+from PyQt5 import QtCore
+from PyQt5 import QtGui
+
+from .annotations import Annotation
+from .label_struct import LabelStruct
+
+from typing import List
+
+MAGIC = b'DCMA'
+VERSION = 2
+EXTENSION = '.ann'
+# 每张切片一个的原有标记文件的扩展名,标记容器中没有某张切片的记录时读取
+LEGACY_EXTENSIONS = ('.ann', '.pkl')
+
+# 类型在文件中以序号保存，只能在末尾增加新的类型
+ANNOTATION_TYPES = ['polygon', 'rectangle', 'point', 'line', 'circle', 'polyline']
+
+# 标志位，FILL与HAS_FILL_COLOR在版本2中加入
+CLOSED, VISIBLE, HAS_LINE_COLOR, FILL, HAS_FILL_COLOR = 1, 2, 4, 8, 16
+
+HEADER = struct.Struct('<4sHI')
+RECORD = struct.Struct('<BBII')
+COLOR = struct.Struct('<I')
+
+
+def dumps_annotations(annotations: List[Annotation]) -> bytes:
+    buffer = io.BytesIO()
+    buffer.write(HEADER.pack(MAGIC, VERSION, len(annotations)))
+    for annotation in annotations:
+        flags = (CLOSED if annotation.isClosed() else 0) | (VISIBLE if annotation.is_visable else 0) | \
+                (FILL if annotation.fill else 0)
+        # 只有在对象上设置过的颜色需要保存，否则使用类属性中的默认颜色
+        line_color = annotation.__dict__.get('line_color')
+        if line_color is not None:
+            flags |= HAS_LINE_COLOR
+        fill_color = annotation.__dict__.get('fill_color')
+        if fill_color is not None:
+            flags |= HAS_FILL_COLOR
+        label = json.dumps(annotation.label.__dict__, ensure_ascii=False).encode('utf-8')
+        buffer.write(RECORD.pack(ANNOTATION_TYPES.index(annotation.annotation_type), flags,
+                                 len(annotation), len(label)))
+        if line_color is not None:
+            buffer.write(COLOR.pack(line_color.rgba()))
+        if fill_color is not None:
+            buffer.write(COLOR.pack(fill_color.rgba()))
+        buffer.write(annotation.coords.astype('<f4').tobytes())
+        buffer.write(label)
+    return buffer.getvalue()
+
+
+def loads_annotations(data: bytes) -> List[Annotation]:
+    magic, version, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('不是标记文件')
+    if version > VERSION:
+        raise ValueError('不支持的标记文件版本: %d' % version)
+    offset = HEADER.size
+    annotations = []
+    for _ in range(count):
+        type_index, flags, point_count, label_length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        annotation = Annotation(annotation_type=ANNOTATION_TYPES[type_index])
+        if flags & HAS_LINE_COLOR:
+            annotation.line_color = QtGui.QColor.fromRgba(COLOR.unpack_from(data, offset)[0])
+            offset += COLOR.size
+        if flags & HAS_FILL_COLOR:
+            annotation.fill_color = QtGui.QColor.fromRgba(COLOR.unpack_from(data, offset)[0])
+            offset += COLOR.size
+        coords = np.frombuffer(data, dtype='<f4', count=point_count * 2, offset=offset)
+        offset += coords.nbytes
+        annotation.points = [QtCore.QPointF(x, y) for x, y in coords.reshape(-1, 2).tolist()]
+        annotation.label = LabelStruct(**json.loads(bytes(data[offset:offset + label_length]).decode('utf-8')))
+        offset += label_length
+        if flags & CLOSED:
+            annotation.close()
+        annotation.is_visable = bool(flags & VISIBLE)
+        annotation.fill = bool(flags & FILL)
+        annotations.append(annotation)
+    return annotations
+
+
+def write_annotations(path: str, annotations: List[Annotation]) -> None:
+    # 先写入临时文件再替换，保存中途出错不会损坏原有的标记文件
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(dumps_annotations(annotations))
+    os.replace(temp_path, path)
+
+
+def read_annotations(path: str) -> List[Annotation]:
+    with open(path, 'rb') as f:
+        return loads_annotations(f.read())
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    '''只允许还原原有.pkl标记文件中出现的类，拒绝其它任何全局对象'''
+
+    ALLOWED_GLOBALS = {
+        ('datatypes.annotations', 'Annotation'),
+        ('datatypes.label_struct', 'LabelStruct'),
+        ('PyQt5.QtCore', 'QPointF'),
+        ('PyQt5.QtCore', 'QPoint'),
+        ('PyQt5.QtGui', 'QColor'),
+        ('copyreg', '_reconstructor'),
+        ('builtins', 'object'),
+        # 协议2及以下的pickle中为Python 2的模块名,由find_class映射到上面的模块
+        ('copy_reg', '_reconstructor'),
+        ('__builtin__', 'object'),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) not in self.ALLOWED_GLOBALS:
+            raise pickle.UnpicklingError('标记文件中不允许的对象: %s.%s' % (module, name))
+        return super(LegacyUnpickler, self).find_class(module, name)
+
+
+def find_legacy_annotations(dicom_path: str) -> str:
+    '''返回dicom文件对应的原有标记文件路径,.ann与.pkl都存在时返回较新的一个,都不存在时返回空字符串'''
+    stem = osp.splitext(dicom_path)[0]
+    paths = [stem + extension for extension in LEGACY_EXTENSIONS if osp.exists(stem + extension)]
+    return max(paths, key=osp.getmtime, default='')
+
+
+def read_legacy_annotations(path: str) -> List[Annotation]:
+    '''读取原有的单个切片的标记文件(.pkl或.ann)'''
+    if path.lower().endswith('.pkl'):
+        with open(path, 'rb') as f:
+            return LegacyUnpickler(f).load()
+    return read_annotations(path)
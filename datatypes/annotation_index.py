@@ -0,0 +1,88 @@
+'''
+实现标记的空间索引，用于画布上的悬停检测和点选
+将图像平面划分为均匀的网格，每个标记登记在其包围盒覆盖的网格中，
+查询一个点时只需检查该点附近网格中的标记，而不是遍历所有标记的所有顶点
+'''
+
+from collections import defaultdict
+
+from typing import List, Tuple
+
+
+class AnnotationIndex(object):
+    '''
+    标记包围盒的网格索引
+    索引通过sync与标记列表同步，同步时比较每个标记的geometry_version，只重新登记发生变化的标记，
+        因此画布上的任何编辑操作都不需要显式地通知索引
+    '''
+
+    # 网格边长，以图像像素为单位
+    CELL_SIZE = 64
+
+    def __init__(self, cell_size: int = None):
+        self.cell_size = cell_size or self.CELL_SIZE
+        # 网格坐标 -> 登记在其中的标记的id集合
+        self.cells = defaultdict(set)
+        # 标记的id -> (标记, 登记时的geometry_version, 包围盒(x1, y1, x2, y2), 覆盖的网格列表)
+        self.entries = {}
+        # 标记的id -> 在标记列表中的位置，用于按创建顺序返回查询结果
+        self.order = {}
+        # 最近一次同步时的[(标记的id, geometry_version)]，未发生变化时跳过同步
+        self._versions = []
+
+    def sync(self, annotations: list) -> None:
+        '''与标记列表同步，增加新的标记，删除不在列表中的标记，重新登记几何形状变化的标记'''
+        versions = [(id(annotation), annotation.geometry_version) for annotation in annotations]
+        if versions == self._versions:
+            return
+        order = {}
+        for position, (annotation, (key, version)) in enumerate(zip(annotations, versions)):
+            entry = self.entries.get(key)
+            if entry is None or entry[0] is not annotation or entry[1] != version:
+                if entry is not None:
+                    self.remove(key)
+                self.insert(annotation)
+            order[key] = position
+        for key in [key for key in self.entries if key not in order]:
+            self.remove(key)
+        self.order = order
+        self._versions = versions
+
+    def insert(self, annotation) -> None:
+        rect = annotation.boundingRect()
+        bounds = (rect.left(), rect.top(), rect.right(), rect.bottom())
+        cells = self.cells_in(*bounds)
+        for cell in cells:
+            self.cells[cell].add(id(annotation))
+        self.entries[id(annotation)] = (annotation, annotation.geometry_version, bounds, cells)
+
+    def remove(self, key: int) -> None:
+        for cell in self.entries.pop(key)[3]:
+            self.cells[cell].discard(key)
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def cells_in(self, x1: float, y1: float, x2: float, y2: float) -> List[Tuple[int, int]]:
+        '''返回矩形覆盖的所有网格坐标'''
+        size = self.cell_size
+        return [(i, j)
+                for i in range(int(min(x1, x2) // size), int(max(x1, x2) // size) + 1)
+                for j in range(int(min(y1, y2) // size), int(max(y1, y2) // size) + 1)]
+
+    def query(self, point, margin: float = 0.0) -> list:
+        '''
+        返回包围盒(向外扩展margin)包含point的标记，后创建的标记在前
+        与point的距离不超过margin的顶点和边，以及包含point的标记，都一定在结果中
+        '''
+        x, y = point.x(), point.y()
+        keys = set()
+        for cell in self.cells_in(x - margin, y - margin, x + margin, y + margin):
+            keys.update(self.cells.get(cell, ()))
+        candidates = []
+        for key in keys:
+            annotation, _, (x1, y1, x2, y2), _ = self.entries[key]
+            if min(x1, x2) - margin <= x <= max(x1, x2) + margin and \
+                    min(y1, y2) - margin <= y <= max(y1, y2) + margin:
+                candidates.append(annotation)
+        candidates.sort(key=lambda annotation: self.order[id(annotation)], reverse=True)
+        return candidates
@@ -7,17 +7,17 @@
 '''
 
 import copy
+import itertools
 import math
+from collections import namedtuple
+
+import numpy as np
 
 from PyQt5 import QtCore
 from PyQt5 import QtGui
 
-import utils
 from datatypes import LabelStruct
 
-# TODO(unknown):
-# - [opt] Store paths instead of creating new ones at each paint.
-
 DEFAULT_LINE_COLOR = QtGui.QColor(0, 255, 0, 128)
 DEFAULT_FILL_COLOR = QtGui.QColor(255, 0, 0, 128)
 DEFAULT_SELECT_LINE_COLOR = QtGui.QColor(255, 255, 255)
@@ -25,6 +25,15 @@ DEFAULT_SELECT_FILL_COLOR = QtGui.QColor(0, 128, 255, 155)
 DEFAULT_VERTEX_FILL_COLOR = QtGui.QColor(0, 255, 0, 255)
 DEFAULT_HVERTEX_FILL_COLOR = QtGui.QColor(255, 0, 0)
 
+# 标记状态的不可变快照，用于撤销和重做
+#   points: 顶点的元组
+#   attributes: 除顶点、缓存和临时显示状态外的全部属性
+# 状态未变化的标记在多个历史记录之间共享同一个快照
+AnnotationMemento = namedtuple('AnnotationMemento', ['points', 'attributes'])
+
+# 全局递增的几何版本号,每次几何变化都得到一个新的版本号,不同annotation(包括副本)之间也不会重复
+_geometry_versions = itertools.count()
+
 
 class Annotation(object):
     # FIXME: 调试用属性，打包/发布前删除
@@ -52,6 +61,11 @@ class Annotation(object):
     #
     scale = 1.0
 
+    # 由几何形状派生的缓存属性，不参与复制和序列化
+    CACHE_ATTRIBUTES = ('_geometry_version', '_path', '_bounding_rect', '_paint_paths', '_coords', '_memento')
+    # 只影响显示的临时状态，不进入快照
+    TRANSIENT_ATTRIBUTES = ('_highlightIndex', '_highlightMode', 'fill', 'vertex_fill_color')
+
     def __init__(self, label=None, line_color=None, annotation_type=None,
                  flags=None):
         # 数据属性：点，标签（只能有一个）和标志（可以有多个）
@@ -75,6 +89,38 @@ class Annotation(object):
             self.line_color = line_color
 
     # ----------property属性----------#
+    @property
+    def points(self):
+        '''顶点列表，修改顶点必须通过赋值或编辑方法进行，直接修改列表不会使缓存失效'''
+        return self._points
+
+    @points.setter
+    def points(self, value):
+        # 复制列表，避免与其它annotation共享同一个列表
+        self._points = list(value)
+        self.invalidate_geometry()
+
+    @property
+    def geometry_version(self):
+        '''几何版本号，顶点或类型变化后改变，外部的缓存(如空间索引)据此判断是否过期'''
+        return self._geometry_version
+
+    def invalidate_geometry(self):
+        '''几何形状变化后调用，使路径和包围盒的缓存失效'''
+        self._geometry_version = next(_geometry_versions)
+        self._path = None
+        self._bounding_rect = None
+        self._paint_paths = None
+        self._coords = None
+        self._memento = None
+
+    @property
+    def coords(self):
+        '''顶点坐标的(n, 2)数组，与points对应，用于向量化的邻近查询'''
+        if self._coords is None:
+            self._coords = np.array([(p.x(), p.y()) for p in self._points], dtype=np.float64).reshape(-1, 2)
+        return self._coords
+
     @property
     def annotation_type(self):
         return self._annotation_type
@@ -88,6 +134,7 @@ class Annotation(object):
                          'line', 'circle', 'polyline']:
             raise ValueError('Unexpected annotation_type: {}'.format(value))
         self._annotation_type = value
+        self.invalidate_geometry()
 
     # ----------重载魔术方法----------#
     def __len__(self):
@@ -99,7 +146,20 @@ class Annotation(object):
 
     # 重载索引赋值方法
     def __setitem__(self, key, value):
-        self.points[key] = value
+        self._points[key] = value
+        self.invalidate_geometry()
+
+    # 复制和序列化时不包含缓存，并保持'points'键，与原有的标记文件兼容
+    def __getstate__(self):
+        state = {key: value for key, value in self.__dict__.items() if key not in self.CACHE_ATTRIBUTES}
+        state['points'] = state.pop('_points')
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        points = state.pop('points', [])
+        self.__dict__.update(state)
+        self.points = points
 
     # -----------查询和设置_closed属性----------#
     def close(self):
@@ -116,46 +176,68 @@ class Annotation(object):
         if self.points and point == self.points[0]:
             self.close()
         else:
-            self.points.append(point)
+            self._points.append(point)
+            self.invalidate_geometry()
 
     def popPoint(self):
         if self.points:
             # question: 应该setOpen？
             self.setOpen()
-            return self.points.pop()
+            point = self._points.pop()
+            self.invalidate_geometry()
+            return point
         return None
 
     def insertPoint(self, i, point):
-        self.points.insert(i, point)
+        self._points.insert(i, point)
+        self.invalidate_geometry()
 
     # -----------获取临近顶点和边----------#
+    # 对coords数组进行一次向量化计算，代替逐点调用utils.distance和utils.distancetoline
     def get_nearest_vertex(self, point, epsilon):
         '''返回annotation中离point最近的的顶点的序号，距离需要小于epsilon，若没有则返回None'''
-        min_distance = float('inf')
-        min_i = None
-        for i, p in enumerate(self.points):
-            # FIXME: 想办法替代distance方法
-            dist = utils.distance(p - point)
-            if dist <= epsilon and dist < min_distance:
-                min_distance = dist
-                min_i = i
-        return min_i
+        if not self._points:
+            return None
+        distances = np.hypot(self.coords[:, 0] - point.x(), self.coords[:, 1] - point.y())
+        # 距离相同时取序号最小的顶点
+        i = int(np.argmin(distances))
+        return i if distances[i] <= epsilon else None
 
     def get_nearest_edge(self, point, epsilon):
-        '''返回annotation中离point最近的的边的序号，距离需要小于epsilon，若没有则返回None'''
-        min_distance = float('inf')
-        post_i = None
-        for i in range(len(self.points)):
-            line = [self.points[i - 1], self.points[i]]
-            dist = utils.distancetoline(point, line)
-            if dist <= epsilon and dist < min_distance:
-                min_distance = dist
-                post_i = i
-        return post_i
+        '''
+        返回annotation中离point最近的的边的序号，距离需要小于epsilon，若没有则返回None
+        第i条边连接第i-1个和第i个顶点(第0条边连接最后一个和第一个顶点)
+        '''
+        if not self._points:
+            return None
+        ends = self.coords
+        starts = np.roll(ends, 1, axis=0)
+        p = np.array([point.x(), point.y()])
+        edges = ends - starts
+        to_start = p - starts
+        to_end = p - ends
+        lengths = np.hypot(edges[:, 0], edges[:, 1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # 垂足在线段内时为点到直线的距离，否则为到较近端点的距离
+            distances = np.abs(edges[:, 0] * to_start[:, 1] - edges[:, 1] * to_start[:, 0]) / lengths
+        before_start = np.einsum('ij,ij->i', to_start, edges) < 0
+        after_end = np.einsum('ij,ij->i', to_end, edges) > 0
+        distances = np.where(before_start, np.hypot(to_start[:, 0], to_start[:, 1]), distances)
+        distances = np.where(after_end & ~before_start, np.hypot(to_end[:, 0], to_end[:, 1]), distances)
+        # 长度为0的边不是有效的边
+        distances[lengths == 0] = np.inf
+        i = int(np.argmin(distances))
+        return i if distances[i] <= epsilon else None
 
     # -----------构造QPainterPath对象----------#
     # 构造这个对象是为了调用其在Qt中的方法实现包含检查和boundbox生成
-    # question: 改写为property？
+    # 构造的结果缓存在path属性中，顶点变化前重复使用
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = self.makePath()
+        return self._path
+
     def makePath(self):
         if self.annotation_type == 'rectangle':
             path = QtGui.QPainterPath()
@@ -175,10 +257,13 @@ class Annotation(object):
 
     # 获取annotation的boundingbox
     def boundingRect(self):
-        return self.makePath().boundingRect()
+        if self._bounding_rect is None:
+            self._bounding_rect = self.path.boundingRect()
+        # 返回副本，调用者对其的修改不影响缓存
+        return QtCore.QRectF(self._bounding_rect)
 
     def containsPoint(self, point):
-        return self.makePath().contains(point)
+        return self.path.contains(point)
 
     # -----------获取矩形和被圆内切的矩形RectF对象----------#
     # insight: 这两个方法的目的也是获取annotation的boundingbox，
@@ -211,6 +296,28 @@ class Annotation(object):
             pen.setWidth(max(1, int(round(2.0 / self.scale))))
             painter.setPen(pen)
 
+            line_path, vrtx_path = self.get_paint_paths()
+            if self._highlightIndex is not None:
+                self.vertex_fill_color = self.hvertex_fill_color
+            else:
+                self.vertex_fill_color = Annotation.vertex_fill_color
+
+            painter.drawPath(line_path)
+            painter.drawPath(vrtx_path)
+            painter.fillPath(vrtx_path, self.vertex_fill_color)
+            if self.fill:
+                color = self.select_fill_color \
+                    if selected else self.fill_color
+                painter.fillPath(line_path, color)
+
+    def get_paint_paths(self):
+        '''
+        返回绘制用的边框路径与顶点路径
+        顶点的尺寸与缩放比例和高亮状态有关，以它们为键缓存最近一次的结果，重绘时不需要重新构造路径
+        '''
+        key = (self.scale, self.point_size, self.point_type, self._closed,
+               self._highlightIndex, self._highlightMode)
+        if self._paint_paths is None or self._paint_paths[0] != key:
             line_path = QtGui.QPainterPath()
             vrtx_path = QtGui.QPainterPath()
 
@@ -247,14 +354,8 @@ class Annotation(object):
                     self.drawVertex(vrtx_path, i)
                 if self.isClosed():
                     line_path.lineTo(self.points[0])
-
-            painter.drawPath(line_path)
-            painter.drawPath(vrtx_path)
-            painter.fillPath(vrtx_path, self.vertex_fill_color)
-            if self.fill:
-                color = self.select_fill_color \
-                    if selected else self.fill_color
-                painter.fillPath(line_path, color)
+            self._paint_paths = (key, line_path, vrtx_path)
+        return self._paint_paths[1], self._paint_paths[2]
 
     def drawVertex(self, path, i):
         d = self.point_size / self.scale
@@ -286,8 +387,37 @@ class Annotation(object):
     def copy(self):
         return copy.deepcopy(self)
 
+    # ----------快照和恢复----------#
+    # 快照只复制顶点列表(不复制顶点本身，顶点只会被整体替换)和各个属性值，而不是像copy那样深复制整个对象
+    # 标签(LabelStruct)和颜色(QColor)可以被原地修改，快照与标记之间不共享这些对象，
+    # 原地修改不会改变已有的快照，并且会因为与快照的值不同而产生新的快照
+    def memento(self):
+        '''返回当前状态的快照，状态未变化时返回上一次的同一个快照'''
+        attributes = {key: value for key, value in self.__dict__.items()
+                      if key != '_points' and key not in self.CACHE_ATTRIBUTES
+                      and key not in self.TRANSIENT_ATTRIBUTES}
+        if self._memento is None:
+            self._memento = AnnotationMemento(tuple(self._points), self.copy_attributes(attributes))
+        elif self._memento.attributes != attributes:
+            # 几何变化会清除快照，因此此时只有属性变化，顶点元组可以共享
+            self._memento = AnnotationMemento(self._memento.points, self.copy_attributes(attributes))
+        return self._memento
+
+    @staticmethod
+    def copy_attributes(attributes):
+        return {key: copy.copy(value) for key, value in attributes.items()}
+
+    def restore(self, memento):
+        '''恢复到快照的状态，已经处于该状态时不做任何修改'''
+        if self.memento() is memento:
+            return
+        self.__dict__.update(self.copy_attributes(memento.attributes))
+        self.points = memento.points
+        self.clear_highlight_vertex()
+        self._memento = memento
+
     def moveBy(self, offset):
         self.points = [p + offset for p in self.points]
 
     def moveVertexBy(self, i, offset):
-        self.points[i] = self.points[i] + offset
+        self[i] = self.points[i] + offset
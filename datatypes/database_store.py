@@ -0,0 +1,238 @@
+'''
+实现数据库的存储后端
+DicomTree在内存中始终是xml ElementTree,存储后端只负责它的持久化,根据文件扩展名选择
+    XmlStore: 整个数据库保存为一个.xml文件,是原有的格式,每次保存都要重写整个文件,
+        单个series的属性变化追加到同名的.journal文件,读取时应用,下一次保存整个数据库时清空
+    SqliteStore: 保存为.db文件,patient/study/series/instance各一张带索引的表,
+        可以在一个事务中只更新单个series的一行(如annotated, modified_timestamp)
+两种格式可以互相转换: python -m datatypes.database_store 源文件 目标文件
+'''
+
+import abc
+import json
+import os
+import os.path as osp
+import sqlite3
+import threading
+from xml.etree.ElementTree import ElementTree, Element, SubElement
+
+from typing import Dict, Tuple
+
+
+class DatabaseStore(abc.ABC):
+    '''存储后端的接口,缺少load或save的后端在创建时即报错,而不是在保存途中'''
+
+    EXTENSIONS = ()
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def for_path(path: str):
+        '''根据扩展名返回对应的存储后端,不支持的扩展名返回None'''
+        for store_class in [XmlStore, SqliteStore]:
+            if osp.splitext(path)[1].lower() in store_class.EXTENSIONS:
+                return store_class(path)
+        return None
+
+    @abc.abstractmethod
+    def load(self) -> Element:
+        '''读取整个数据库,返回database根元素'''
+
+    @abc.abstractmethod
+    def save(self, root: Element) -> None:
+        '''保存整个数据库'''
+
+    def update_series(self, series_key: Tuple[str, str, str], attrib: Dict[str, str]) -> bool:
+        '''
+        只持久化一个series的属性变化,series_key为(patient id, study uid, series uid)
+        返回False表示后端不支持单独更新,调用者需要保存整个数据库
+        '''
+        return self.update_series_many({series_key: attrib})
+
+    def update_series_many(self, updates: Dict[Tuple[str, str, str], Dict[str, str]]) -> bool:
+        '''
+        一次持久化多个series的属性变化,形式为{series_key: attrib},返回值同update_series
+        这是可选的能力,缺省返回False,由调用者改为保存整个数据库
+        '''
+        return False
+
+
+class XmlStore(DatabaseStore):
+    '''
+    原有的.xml格式
+    series的属性变化以json行的形式追加到journal_path,每行形如{"key": [patient id, study uid, series uid], "attrib": {...}}
+    '''
+
+    EXTENSIONS = ('.xml',)
+
+    # 后台线程追加journal与界面线程保存整个数据库(清空journal)之间互斥
+    journal_lock = threading.Lock()
+
+    @property
+    def journal_path(self) -> str:
+        return self.path + '.journal'
+
+    def load(self) -> Element:
+        root = ElementTree().parse(self.path)
+        self.apply_journal(root)
+        return root
+
+    def apply_journal(self, root: Element) -> None:
+        '''按顺序应用journal中记录的series属性变化'''
+        if not osp.exists(self.journal_path):
+            return
+        series_elements = {(patient.get('id'), study.get('uid'), series.get('uid')): series
+                           for patient in root for study in patient for series in study}
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                # 追加中途出错会留下不完整的行,跳过
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                series = series_elements.get(tuple(record['key']))
+                if series is not None:
+                    series.attrib.update(record['attrib'])
+
+    def save(self, root: Element) -> None:
+        # 先写入临时文件再替换,保存中途出错不会损坏原有的数据库文件
+        temp_path = self.path + '.tmp'
+        with self.journal_lock:
+            ElementTree(root).write(temp_path, encoding='utf-8', xml_declaration=True)
+            os.replace(temp_path, self.path)
+            # journal中的变化已经包含在新保存的数据库中
+            if osp.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+    def update_series_many(self, updates: Dict[Tuple[str, str, str], Dict[str, str]]) -> bool:
+        with self.journal_lock, open(self.journal_path, 'a+b') as f:
+            # 上一次追加中途出错时,末尾的不完整行需要先结束,否则会与新的记录连在一起
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+            for series_key, attrib in updates.items():
+                f.write(json.dumps({'key': list(series_key), 'attrib': attrib},
+                                   ensure_ascii=False).encode('utf-8') + b'\n')
+        return True
+
+
+class SqliteStore(DatabaseStore):
+    '''
+    SQLite格式,每一级一张表,以top-down uid为主键,database根元素的属性保存在meta表中
+    position列记录元素在父元素中的位置,保证与xml互相转换时顺序不变
+    '''
+
+    EXTENSIONS = ('.db', '.sqlite')
+
+    # 各级元素的属性,依次对应表中的列,顺序与DicomTree.add_metadata中一致
+    ATTRIBUTES = {
+        'patient': ['id', 'name'],
+        'study': ['uid', 'id', 'date', 'time'],
+        'series': ['uid', 'number', 'description', 'annotated',
+                   'imported_timestamp', 'modified_timestamp'],
+        'instance': ['uid', 'number', 'path', 'size', 'mtime'],
+    }
+    # 各级元素的上级元素主键列
+    PARENT_COLUMNS = {
+        'patient': [],
+        'study': ['patient_id'],
+        'series': ['patient_id', 'study_uid'],
+        'instance': ['patient_id', 'study_uid', 'series_uid'],
+    }
+    # 各级元素在其上级元素中的标识属性
+    KEY_ATTRIBUTES = {'patient': 'id', 'study': 'uid', 'series': 'uid', 'instance': 'uid'}
+    TAGS = ['patient', 'study', 'series', 'instance']
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        self.create_tables(connection)
+        return connection
+
+    def create_tables(self, connection: sqlite3.Connection) -> None:
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        for tag in self.TAGS:
+            key_columns = self.PARENT_COLUMNS[tag] + [self.KEY_ATTRIBUTES[tag]]
+            columns = ['"%s" TEXT' % column for column in self.PARENT_COLUMNS[tag] + self.ATTRIBUTES[tag]]
+            connection.execute('CREATE TABLE IF NOT EXISTS %s (%s, position INTEGER, PRIMARY KEY (%s))' % (
+                tag, ', '.join(columns), ', '.join(key_columns)))
+        connection.execute('CREATE INDEX IF NOT EXISTS instance_path ON instance (path)')
+        connection.commit()
+
+    def load(self) -> Element:
+        connection = self.connect()
+        try:
+            root = Element('database', dict(connection.execute('SELECT key, value FROM meta')))
+            # top-down uid元组 -> Element,用于将下一级元素挂到其上级元素
+            elements = {(): root}
+            for tag in self.TAGS:
+                parent_columns = self.PARENT_COLUMNS[tag]
+                attributes = self.ATTRIBUTES[tag]
+                key_index = attributes.index(self.KEY_ATTRIBUTES[tag])
+                rows = connection.execute('SELECT %s FROM %s ORDER BY %s' % (
+                    ', '.join('"%s"' % column for column in parent_columns + attributes), tag,
+                    ', '.join(parent_columns + ['position'])))
+                for row in rows:
+                    parent_key = tuple(row[:len(parent_columns)])
+                    values = row[len(parent_columns):]
+                    element = SubElement(elements[parent_key], tag,
+                                         {attribute: value for attribute, value in zip(attributes, values)
+                                          if value is not None})
+                    if tag != 'instance':
+                        elements[parent_key + (values[key_index],)] = element
+            return root
+        finally:
+            connection.close()
+
+    def save(self, root: Element) -> None:
+        '''在一个事务中重写所有表,中途出错时数据库保持原样'''
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM meta')
+                connection.executemany('INSERT INTO meta VALUES (?, ?)', root.attrib.items())
+                rows = {tag: [] for tag in self.TAGS}
+                self.collect_rows(root, (), rows)
+                for tag in self.TAGS:
+                    columns = self.PARENT_COLUMNS[tag] + self.ATTRIBUTES[tag] + ['position']
+                    connection.execute('DELETE FROM %s' % tag)
+                    connection.executemany('INSERT INTO %s VALUES (%s)' % (
+                        tag, ', '.join('?' * len(columns))), rows[tag])
+        finally:
+            connection.close()
+
+    def collect_rows(self, parent: Element, parent_key: Tuple[str, ...], rows: Dict[str, list]) -> None:
+        for position, element in enumerate(parent):
+            rows[element.tag].append(parent_key +
+                                     tuple(element.get(attribute) for attribute in self.ATTRIBUTES[element.tag]) +
+                                     (position,))
+            if element.tag != 'instance':
+                self.collect_rows(element, parent_key + (element.get(self.KEY_ATTRIBUTES[element.tag]),), rows)
+
+    def update_series_many(self, updates: Dict[Tuple[str, str, str], Dict[str, str]]) -> bool:
+        '''在一个事务中更新所有series'''
+        connection = self.connect()
+        try:
+            with connection:
+                for series_key, attrib in updates.items():
+                    columns = [column for column in attrib if column in self.ATTRIBUTES['series']]
+                    if not columns:
+                        continue
+                    connection.execute('UPDATE series SET %s WHERE patient_id = ? AND study_uid = ? AND uid = ?' % (
+                        ', '.join('"%s" = ?' % column for column in columns)),
+                        [attrib[column] for column in columns] + list(series_key))
+        finally:
+            connection.close()
+        return True
+
+
+def convert(source_path: str, target_path: str) -> None:
+    '''在两种格式之间转换数据库,如将原有的.xml数据库导入为.db'''
+    DatabaseStore.for_path(target_path).save(DatabaseStore.for_path(source_path).load())
+
+
+if __name__ == '__main__':
+    import sys
+
+    convert(sys.argv[1], sys.argv[2])
@@ -3,32 +3,112 @@ import os
 import os.path as osp
 from xml.etree.ElementTree import ElementTree,Element
 
+import bisect
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-from typing import Tuple, List, Dict, Set
+from typing import Tuple, List, Dict, Set, Iterator, Callable
+
+from .database_store import DatabaseStore
+
+# 标记容器路径 -> ((容器的大小, 修改时间), 容器中是否有标记),见DicomTree.is_annotated,每个进程一份
+_annotated_containers = {}  # type: Dict[str, Tuple[Tuple[int, int], bool]]
+# 目录 -> (目录的修改时间, 其中有原有标记文件(.ann或.pkl)的文件名(不含扩展名))
+_legacy_annotations = {}  # type: Dict[str, Tuple[int, Set[str]]]
 
 def digit000(digits: str) -> str:
-    if len(digits) <= 3:
-        return '0' * (3 - len(digits)) + digits
+    # 不足三位时补零,超过三位(如上千张切片的序列)时保持原样
+    return digits.zfill(3)
 
 class DicomTree(ElementTree):
     '''实现三级dicom文件信息树状存储的数据类,从xml ElementTree继承'''
 
     NOT_ANNOTATED, SYSTEM_DEFINED_ANNOTATED, USER_DEFINED_ANNOTATED = '0', '1', '2'
 
+    # 建库需要的全部元数据标签,与get_necessary_meatadata保持一致
+    NECESSARY_TAGS = [
+        (0x0008, 0x0018),  # Instance UID
+        (0x0008, 0x0020),  # Study Date
+        (0x0008, 0x0030),  # Study Time
+        (0x0008, 0x103E),  # Series Description
+        (0x0010, 0x0010),  # Patient Name
+        (0x0010, 0x0020),  # Patient ID
+        (0x0020, 0x000D),  # Study UID
+        (0x0020, 0x000E),  # Series UID
+        (0x0020, 0x0010),  # Study ID
+        (0x0020, 0x0011),  # Series Number
+        (0x0020, 0x0013),  # Instance Number
+    ]
+
+    # 变化事件的类型,与发生变化的元素的top-down uid元组一起通知监听者,元组的长度即元素的级别
+    ELEMENT_ADDED, ELEMENT_UPDATED, ELEMENT_REMOVED = 'added', 'updated', 'removed'
+
+    # 各级元素在父元素中排序所依据的属性
+    SORT_ATTRIBUTES = {'patient': 'id', 'study': 'id', 'series': 'number', 'instance': 'number'}
+
     def __init__(self):
         super(DicomTree, self).__init__()
+        # 索引在第一次使用时建立,根元素变化时失效
+        self._index = None
+        self._sort_keys = None
+        self._path_index = None
+        # 变化事件的监听者,形如callback(event, key)
+        self.listeners = []
+
+    def add_listener(self, callback: Callable[[str, Tuple[str, ...]], None]) -> None:
+        '''注册变化事件的监听者,Dicom树中的元素被增加,修改或删除时,监听者会被调用'''
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[str, Tuple[str, ...]], None]) -> None:
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def _notify(self, events: List[Tuple[str, Tuple[str, ...]]]) -> None:
+        for event, key in events:
+            for callback in self.listeners:
+                callback(event, key)
+
+    def _setroot(self, element: Element) -> None:
+        super(DicomTree, self)._setroot(element)
+        self._index = None
+
+    def parse(self, source, parser=None) -> Element:
+        root = super(DicomTree, self).parse(source, parser)
+        self._index = None
+        return root
 
     @staticmethod
-    def load(xml_path: str):
+    def load(database_path: str):
+        '''从.xml或.db文件加载数据库,存储格式由扩展名决定,见DatabaseStore'''
         dicom_tree = DicomTree()
-        dicom_tree.parse(xml_path)
+        dicom_tree._setroot(DatabaseStore.for_path(database_path).load())
+        # 打开数据库时即建立索引,之后的查找和插入都不需要再遍历整棵树
+        dicom_tree._build_index()
         return dicom_tree
 
     def save(self, fp: str):
-        if not fp.endswith('.xml'):
+        '''保存到.xml或.db文件,存储格式由扩展名决定,不支持的扩展名不进行保存'''
+        store = DatabaseStore.for_path(fp)
+        if store is None:
             return
-        self.write(fp, encoding='utf-8',xml_declaration=True)
+        store.save(self._root)
+
+    def set_series_attrib(self, uids: List[str], attrib: Dict[str, str]) -> Tuple[str, str, str]:
+        '''只在内存中修改一个series的属性并通知监听者,返回series的top-down uid元组'''
+        series_key = tuple(uids[:3])
+        self.index[series_key].attrib.update(attrib)
+        self._notify([(self.ELEMENT_UPDATED, series_key)])
+        return series_key
+
+    def persist_series(self, fp: str, updates: Dict[Tuple[str, str, str], Dict[str, str]]) -> bool:
+        '''
+        将若干series的属性变化持久化到数据库文件fp,形式为{series_key: attrib}
+        只读写数据库文件,不访问Dicom树,可以在后台线程中执行
+        返回False表示后端不支持单独更新,调用者需要在修改Dicom树的线程中保存整个数据库
+        '''
+        store = DatabaseStore.for_path(fp)
+        return store is None or store.update_series_many(updates)
 
     @property
     def patients(self) -> Set[str]:
@@ -43,17 +123,121 @@ class DicomTree(ElementTree):
         return set(study_uid_list)
 
     @staticmethod
-    def load_from_dir(dir: str, name: str):
-        '''递归遍历指定路径，收集其中所有dicom文件建立Dicom树'''
+    def load_from_dir(dir: str, name: str, workers: int = None):
+        '''
+        递归遍历指定路径，收集其中所有dicom文件建立Dicom树
+        元数据的读取由workers个进程并行完成，合并到Dicom树的工作在主进程按文件顺序进行，
+            因此结果与串行读取完全一致;workers为1时直接在主进程串行读取
+        '''
         dicom_tree = DicomTree()
-        dicom_tree._root = Element('database')
-        dicom_tree._root.attrib = {'name': name}
-        # 递归遍历指定目录下所有的文件，读取所有dicom文件的元信息，增加到Dicom树
+        # 记录建库的目录,增量同步时重新扫描这个目录
+        dicom_tree._setroot(Element('database', {'name': name, 'dir': dir}))
+        # 读取所有dicom文件的元信息，增加到Dicom树
+        for fp, metadata_dict in DicomTree.iter_metadata(DicomTree.collect_dicom_files(dir), workers):
+            dicom_tree.add_metadata(fp, metadata_dict)
+        return dicom_tree
+
+    @staticmethod
+    def collect_dicom_files(dir: str, is_canceled: Callable[[], bool] = None) -> List[str]:
+        '''
+        递归遍历指定目录下所有的文件，收集所有dicom文件的路径
+        is_canceled在进入每个目录前被调用,返回True时停止遍历,返回已收集的部分
+        '''
+        fps = []
         for root, dirs, files in os.walk(dir):
+            if is_canceled is not None and is_canceled():
+                break
             for file in files:
                 if file.lower().endswith('.dcm'):
-                    dicom_tree.add_file(osp.join(root, file))
-        return dicom_tree
+                    fps.append(osp.join(root, file))
+        return fps
+
+    @staticmethod
+    def iter_metadata(fps: List[str], workers: int = None,
+                      chunk_size: int = 64) -> Iterator[Tuple[str, Dict[str, str]]]:
+        '''
+        按fps的顺序产生(路径, 元数据)
+        workers缺省时使用全部cpu核心,文件按chunk_size分块提交给进程池,以摊薄进程间通信的开销
+        同时在途的分块数量有上限,中途停止迭代时,尚未开始的分块会被取消
+        '''
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1 or len(fps) <= chunk_size:
+            for fp in fps:
+                yield fp, DicomTree.read_metadata(fp)
+            return
+
+        executor = ProcessPoolExecutor(max_workers=workers)
+        pending = deque()
+        try:
+            for i in range(0, len(fps), chunk_size):
+                pending.append(executor.submit(read_metadata_chunk, fps[i:i + chunk_size]))
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+
+    @staticmethod
+    def read_header(fp) -> pydicom.Dataset:
+        '''
+        只读取文件头中建库需要的标签
+        在像素数据之前停止解析,像素数据(一张CT约0.5MB)不会被读取,其余不需要的标签也不会被解析
+        '''
+        return pydicom.dcmread(fp, stop_before_pixels=True,
+                               specific_tags=DicomTree.NECESSARY_TAGS)
+
+    @staticmethod
+    def read_metadata(fp: str) -> Dict[str, str]:
+        '''读取单个文件建库需要的元数据,可以在工作进程中执行'''
+        dicom_object = DicomTree.read_header(fp)
+        metadata_dict = DicomTree.get_necessary_meatadata(dicom_object)
+        # 根据序列的标记容器与原有的标记文件,在series级上标记序列的被标记状况
+        # 在工作进程中检查,合并到Dicom树时(界面线程)不再访问文件系统
+        metadata_dict['Annotated'] = DicomTree.is_annotated(fp, metadata_dict['Series UID'])
+        # 文件指纹,增量同步时据此判断文件是否发生了变化
+        metadata_dict['File Size'], metadata_dict['File Mtime'] = DicomTree.get_fingerprint(fp)
+        return metadata_dict
+
+    @staticmethod
+    def is_annotated(fp: str, series_uid: str) -> bool:
+        '''
+        文件所属序列的标记容器中是否有标记,或文件是否有尚未写入容器的原有标记文件
+        结果缓存在当前进程中,容器与目录没有变化(大小与修改时间相同)时,同一个序列的容器只读取一次,同一个目录只列出一次
+        '''
+        # annotation_container依赖Annotation,在模块级别导入会与datatypes包的初始化形成循环导入
+        from .annotation_container import AnnotationContainer, container_path
+        from .annotation_file import LEGACY_EXTENSIONS
+        path = container_path(fp, series_uid)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None:
+            version = (stat.st_size, stat.st_mtime_ns)
+            entry = _annotated_containers.get(path)
+            # 容器在检查之后被写入(如自动保存,迁移,其他程序实例)时重新检查,检查时只读取记录的头部
+            if entry is None or entry[0] != version:
+                entry = _annotated_containers[path] = (version, AnnotationContainer(path, verify=False).annotated)
+            if entry[1]:
+                return True
+        directory, name = osp.split(fp)
+        version = os.stat(directory).st_mtime_ns
+        entry = _legacy_annotations.get(directory)
+        if entry is None or entry[0] != version:
+            entry = _legacy_annotations[directory] = (version, {
+                osp.splitext(file)[0] for file in os.listdir(directory)
+                if osp.splitext(file)[1].lower() in LEGACY_EXTENSIONS})
+        return osp.splitext(name)[0] in entry[1]
+
+    @staticmethod
+    def get_fingerprint(fp: str) -> Tuple[str, str]:
+        '''文件指纹(大小, 修改时间),以字符串形式存储在instance元素的属性中'''
+        stat = os.stat(fp)
+        return str(stat.st_size), str(stat.st_mtime_ns)
 
     @staticmethod
     def get_necessary_meatadata(dicom_object):
@@ -81,61 +265,56 @@ class DicomTree(ElementTree):
         这是定义Dicom树的核心方法
             因为Dicom树本质上只是具有特定Element和Attribute的xml树,提取和维护哪些属性就决定了DicomTree的定义
         '''
-        # TEST
-        print(fp)
         '''将.dcm文件索引加入Dicom树'''
         if not fp.endswith('.dcm'):
             return
 
-        dicom_object = pydicom.dcmread(fp)
-
-        metadata_dict = DicomTree.get_necessary_meatadata(dicom_object)
+        self.add_metadata(fp, DicomTree.read_metadata(fp))
 
+    def add_metadata(self, fp: str, metadata_dict: Dict[str, str]) -> None:
+        '''将已经读取的元数据加入Dicom树,并行建库时由主进程调用'''
         # 逐级检查标识符，若无则创建，若有则添加到其上
+        # 通过索引查找各级元素,通过有序的排序键列表二分查找插入位置,每次添加的代价为O(log n)
+        index = self.index
+        # 所有元素都加入之后再自顶向下地通知监听者,监听者收到事件时,元素的子元素已经完整
+        events = []
+
         # 检查是否已有此患者
-        patient_id_list = [patient.get('id') for patient in list(self._root)]
-        patient_id = metadata_dict['Patient ID']
-        if patient_id not in patient_id_list:
+        patient_key = (metadata_dict['Patient ID'],)
+        current_patient = index.get(patient_key)
+        if current_patient is None:
             # 构建新的patient元素
-            new_patient = Element('patient')
-            new_patient.attrib = {
+            current_patient = Element('patient')
+            current_patient.attrib = {
                 'id': metadata_dict['Patient ID'],
                 'name': metadata_dict['Patient Name']
             }
             # 根据patient id进行排序，将新的patient元素插入合适的位置
-            patient_id_list.append(metadata_dict['Patient ID'])
-            index = sorted(patient_id_list).index(metadata_dict['Patient ID'])
-            self._root.insert(index, new_patient)
-            current_patient = new_patient
-        else:
-            current_patient = list(self._root)[patient_id_list.index(patient_id)]
+            self._insert_sorted((), self._root, current_patient, metadata_dict['Patient ID'])
+            index[patient_key] = current_patient
+            events.append((self.ELEMENT_ADDED, patient_key))
 
         # 检查是否已有此study，执行操作同上
-        study_uid_list = [study.get('uid') for study in current_patient.findall('study')]
-        study_id_list = [study.get('id') for study in current_patient.findall('study')]
-        study_uid = metadata_dict['Study UID']
-        if study_uid not in study_uid_list:
-            new_study = Element('study')
-            new_study.attrib = {
+        study_key = patient_key + (metadata_dict['Study UID'],)
+        current_study = index.get(study_key)
+        if current_study is None:
+            current_study = Element('study')
+            current_study.attrib = {
                 'uid': metadata_dict['Study UID'],
                 'id': metadata_dict['Study ID'],
                 'date': metadata_dict['Study Date'],
                 'time': metadata_dict['Study Time']
             }
-            study_id_list.append(metadata_dict['Study ID'])
-            index = sorted(study_id_list).index(metadata_dict['Study ID'])
-            current_patient.insert(index, new_study)
-            current_study = new_study
-        else:
-            current_study = list(current_patient)[study_uid_list.index(study_uid)]
+            self._insert_sorted(patient_key, current_patient, current_study, metadata_dict['Study ID'])
+            index[study_key] = current_study
+            events.append((self.ELEMENT_ADDED, study_key))
 
         # 检查是否已有此series，执行操作同上
-        series_uid_list = [series.get('uid') for series in current_study.findall('series')]
-        series_number_list = [series.get('number') for series in current_study.findall('series')]
-        series_uid = metadata_dict['Series UID']
-        if  series_uid not in series_uid_list:
-            new_series = Element('series')
-            new_series.attrib = {
+        series_key = study_key + (metadata_dict['Series UID'],)
+        current_series = index.get(series_key)
+        if current_series is None:
+            current_series = Element('series')
+            current_series.attrib = {
                 'uid': metadata_dict['Series UID'],
                 'number': metadata_dict['Series Number'],
                 'description': metadata_dict['Series Description'],
@@ -145,70 +324,202 @@ class DicomTree(ElementTree):
                 'imported_timestamp' : str(time.time()),
                 'modified_timestamp' : ''
             }
-            series_number_list.append(metadata_dict['Series Number'])
-            index = sorted(series_number_list).index(metadata_dict['Series Number'])
-            current_study.insert(index, new_series)
-            current_series = new_series
-        else:
-            current_series = list(current_study)[series_uid_list.index(series_uid)]
-        # 根据标记文件的存在性,在series级上标记序列的被标记状况
-        if osp.exists(fp.replace('.dcm', '.pkl')):
+            self._insert_sorted(study_key, current_study, current_series, metadata_dict['Series Number'])
+            index[series_key] = current_series
+            events.append((self.ELEMENT_ADDED, series_key))
+        # 根据read_metadata的检查结果,在series级上标记序列的被标记状况
+        if metadata_dict['Annotated'] and current_series.get('annotated') == self.NOT_ANNOTATED:
             current_series.attrib.update({'annotated' : self.SYSTEM_DEFINED_ANNOTATED})
+            if not events or events[-1][1] != series_key:
+                events.append((self.ELEMENT_UPDATED, series_key))
 
         # 检查是否已有此instance
-        instance_uid_list = [instance.get('uid') for instance in current_series.findall('instance')]
-        instance_number_list = [instance.get('number') for instance in
-                                current_series.findall('instance')]
-        instance_uid = metadata_dict['Instance UID']
-
-        if  instance_uid not in instance_uid_list:
-            new_instance = Element('instance')
-            new_instance.attrib = {
+        instance_key = series_key + (metadata_dict['Instance UID'],)
+        current_instance = index.get(instance_key)
+        if current_instance is None:
+            current_instance = Element('instance')
+            current_instance.attrib = {
                 'uid': metadata_dict['Instance UID'],
                 'number': metadata_dict['Instance Number'],
                 'path': fp
             }
             # 根据instance number进行排序
-            instance_number_list.append(metadata_dict['Instance Number'])
-            index = sorted(instance_number_list).index(metadata_dict['Instance Number'])
-            current_series.insert(index, new_instance)
+            self._insert_sorted(series_key, current_series, current_instance, metadata_dict['Instance Number'])
+            index[instance_key] = current_instance
+            events.append((self.ELEMENT_ADDED, instance_key))
+        else:
+            if current_instance.get('path') != fp:
+                # 同一instance的文件被移动,以新的路径为准
+                self._path_index.pop(current_instance.get('path'), None)
+                current_instance.set('path', fp)
+            events.append((self.ELEMENT_UPDATED, instance_key))
+        current_instance.set('size', metadata_dict['File Size'])
+        current_instance.set('mtime', metadata_dict['File Mtime'])
+        self._path_index[fp] = instance_key
+        self._notify(events)
+
+    @property
+    def index(self) -> Dict[Tuple[str, ...], Element]:
+        '''从top-down uid元组到Element的索引,在第一次使用时根据现有内容建立'''
+        if self._index is None:
+            self._build_index()
+        return self._index
+
+    @property
+    def path_index(self) -> Dict[str, Tuple[str, ...]]:
+        '''从文件路径到instance的top-down uid元组的索引,与index一同建立'''
+        if self._index is None:
+            self._build_index()
+        return self._path_index
+
+    def _build_index(self) -> None:
+        '''
+        根据Dicom树的现有内容建立索引
+            _index: top-down uid元组 -> Element
+            _sort_keys: 父元素的top-down uid元组 -> 其子元素排序键的有序列表
+            _path_index: 文件路径 -> instance的top-down uid元组
+        '''
+        self._index = {}
+        self._sort_keys = {}
+        self._path_index = {}
+        if self._root is None:
+            return
+        self._sort_keys[()] = sorted(patient.get('id') for patient in self._root)
+        for patient in self._root:
+            patient_key = (patient.get('id'),)
+            self._index[patient_key] = patient
+            self._sort_keys[patient_key] = sorted(study.get('id') for study in patient)
+            for study in patient:
+                study_key = patient_key + (study.get('uid'),)
+                self._index[study_key] = study
+                self._sort_keys[study_key] = sorted(series.get('number') for series in study)
+                for series in study:
+                    series_key = study_key + (series.get('uid'),)
+                    self._index[series_key] = series
+                    self._sort_keys[series_key] = sorted(instance.get('number') for instance in series)
+                    for instance in series:
+                        instance_key = series_key + (instance.get('uid'),)
+                        self._index[instance_key] = instance
+                        self._path_index[instance.get('path')] = instance_key
+
+    def _insert_sorted(self, parent_key: Tuple[str, ...], parent: Element,
+                       child: Element, sort_key: str) -> None:
+        '''
+        按排序键将子元素插入父元素的合适位置
+        相同排序键的元素中,后加入的在前(bisect_left),与原先sorted(...).index(...)的插入位置一致,
+            因此与原有代码建立的数据库顺序相同
+        '''
+        sort_keys = self._sort_keys.setdefault(parent_key, [])
+        position = bisect.bisect_left(sort_keys, sort_key)
+        sort_keys.insert(position, sort_key)
+        parent.insert(position, child)
 
     def add_files(self, fps: list) -> None:
         '''将若干文件加入Dicom树，只有dcm文件会被添加'''
         for fp in fps:
             self.add_file(fp)
 
+    def remove_file(self, fp: str, prune: bool = True) -> None:
+        '''从Dicom树中删除文件对应的instance,prune为True时,同时删除因此变空的series,study和patient'''
+        instance_key = self.path_index.pop(fp, None)
+        if instance_key is None:
+            return
+        self._remove_element(instance_key)
+        if prune:
+            self._prune(instance_key[:-1])
+
+    def _remove_element(self, key: Tuple[str, ...]) -> None:
+        element = self._index.pop(key)
+        parent = self._index[key[:-1]] if len(key) > 1 else self._root
+        parent.remove(element)
+        self._sort_keys[key[:-1]].remove(element.get(self.SORT_ATTRIBUTES[element.tag]))
+        self._sort_keys.pop(key, None)
+        self._notify([(self.ELEMENT_REMOVED, key)])
+
+    def _prune(self, key: Tuple[str, ...]) -> None:
+        '''自下而上删除没有子元素的元素'''
+        while key and key in self._index and not len(self._index[key]):
+            self._remove_element(key)
+            key = key[:-1]
+
+    def merge(self, records: List[Tuple[str, Dict[str, str]]], removed_fps: List[str] = ()) -> None:
+        '''
+        合并一次导入或同步的结果
+            removed_fps: 已经不存在的文件,其instance被删除
+            records: 新读取的(路径, 元数据),若路径已在Dicom树中(文件发生了变化),先删除原有的instance
+        删除变化文件的原有instance时暂不清理空的上级元素,以便同一序列的文件重新加入时保留序列的状态
+        '''
+        for _ in self.iter_merge(records, removed_fps):
+            pass
+
+    def iter_merge(self, records: List[Tuple[str, Dict[str, str]]], removed_fps: List[str] = (),
+                   batch_size: int = 500) -> Iterator[int]:
+        '''
+        分批进行merge,每处理batch_size个文件产生一次已处理的文件数,最后一次产生时合并已经完成
+        界面线程中的调用者可以在两批之间处理其它事件,合并大量文件时界面保持响应
+        '''
+        path_index = self.path_index
+        emptied_keys = set()
+        count = 0
+        for fp in removed_fps:
+            self.remove_file(fp)
+            count += 1
+            if count % batch_size == 0:
+                yield count
+        for fp, metadata_dict in records:
+            instance_key = path_index.get(fp)
+            if instance_key is not None and instance_key[-1] != metadata_dict['Instance UID']:
+                emptied_keys.add(instance_key[:-1])
+                self.remove_file(fp, prune=False)
+            self.add_metadata(fp, metadata_dict)
+            count += 1
+            if count % batch_size == 0:
+                yield count
+        for key in emptied_keys:
+            self._prune(key)
+        yield count
+
+    def fingerprints(self) -> Dict[str, Tuple[str, str]]:
+        '''所有文件的指纹 路径 -> (大小, 修改时间),缺少指纹的文件(旧版本建立的数据库)为(None, None)'''
+        index = self.index
+        return {fp: (index[key].get('size'), index[key].get('mtime'))
+                for fp, key in self.path_index.items()}
+
+    @staticmethod
+    def diff_dir(dir: str, fingerprints: Dict[str, Tuple[str, str]],
+                 is_canceled: Callable[[], bool] = None) -> Tuple[List[str], List[str]]:
+        '''
+        将目录的现状与已有的文件指纹比较,用于增量同步
+        返回(新增或变化的文件, 已被删除的文件),只有变化的文件需要重新读取元数据
+        遍历被is_canceled取消时结果不完整(未遍历到的文件会被当作已删除),调用者不能使用
+        '''
+        changed_fps = []
+        found_fps = set()
+        for fp in DicomTree.collect_dicom_files(dir, is_canceled):
+            found_fps.add(fp)
+            if fingerprints.get(fp) != DicomTree.get_fingerprint(fp):
+                changed_fps.append(fp)
+        dir_prefix = osp.join(osp.normcase(osp.normpath(dir)), '')
+        removed_fps = [fp for fp in fingerprints
+                       if fp not in found_fps and osp.normcase(osp.normpath(fp)).startswith(dir_prefix)]
+        return changed_fps, removed_fps
+
     def get_element_from_top_down_uid(self, uids: List[str]) -> Element:
         '''
         根据从前往后，自顶向下的uid列表查找element,返回element
         uid列表形式如同[patientID studyUID seriesUID instanceUID],根据查找的级别后面的ID可以缺省
+        通过索引查找,代价为O(1);若完整的uid列表找不到对应元素,返回能找到的最深一级的元素
         '''
-        result_element = None
-        if uids:
-            patient_id = uids.pop(0)
-            for patient in self.getroot().findall('patient'):
-                if patient.attrib['id'] == patient_id:
-                    result_element = patient
-                    break
-            if uids and result_element:
-                study_uid = uids.pop(0)
-                for study in result_element.findall('study'):
-                    if study.attrib['uid'] == study_uid:
-                        result_element = study
-                        break
-                if uids and result_element:
-                    series_uid = uids.pop(0)
-                    for series in result_element.findall('series'):
-                        if series.attrib['uid'] == series_uid:
-                            result_element = series
-                            break
-                    if uids and result_element:
-                        instance_uid = uids.pop(0)
-                        for instance in result_element.findall('instance'):
-                            if instance.attrib['uid'] == instance_uid:
-                                result_element = instance
-                                break
-        return result_element
+        index = self.index
+        for depth in range(len(uids), 0, -1):
+            result_element = index.get(tuple(uids[:depth]))
+            if result_element is not None:
+                return result_element
+        return None
+
+def read_metadata_chunk(fps: List[str]) -> List[Tuple[str, Dict[str, str]]]:
+    '''进程池的工作函数,需要定义在模块级别才能被pickle传递到工作进程'''
+    return [(fp, DicomTree.read_metadata(fp)) for fp in fps]
 
 if __name__ == '__main__':
 
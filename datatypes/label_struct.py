@@ -1,3 +1,7 @@
 class LabelStruct(object):
     def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
\ No newline at end of file
+        self.__dict__.update(kwargs)
+
+    # 按内容比较，标记的快照据此判断标签是否被修改
+    def __eq__(self, other):
+        return isinstance(other, LabelStruct) and self.__dict__ == other.__dict__
\ No newline at end of file
@@ -3,11 +3,15 @@
 
 from PyQt5.QtWidgets import QApplication, QWidget, QDialog, QLabel, QLineEdit, QProgressBar, \
     QPushButton, QVBoxLayout, QHBoxLayout, QGridLayout, QDialogButtonBox
-from PyQt5.QtCore import Qt, QBasicTimer, QThread
+from PyQt5.QtCore import Qt, QBasicTimer, QThread, pyqtSignal
 import sys
 
 
 class ProgressBar(QDialog):
+
+    # 通知用户点击了取消按钮
+    canceled_signal = pyqtSignal()
+
     def __init__(self, fileIndex, filenum, parent=None):
         super(ProgressBar, self).__init__(parent)
 
@@ -57,5 +61,15 @@ class ProgressBar(QDialog):
     def setValue(self, value):
         self.FeatProgressBar.setValue(value)
 
+    def setProgress(self, fileIndex, filenum):
+        '''同时刷新进度条(换算为100)和文件计数'''
+        self.TipLabel.setText(self.tr("Processing:" + "   " + str(fileIndex) + "/" + str(filenum)))
+        self.setValue(int(fileIndex * 100 / filenum) if filenum else 100)
+
     def onCancel(self, event):
-        self.close()
+        self.reject()
+
+    def reject(self):
+        '''取消按钮,Esc键与窗口的关闭按钮都会调用reject,都视为取消'''
+        self.canceled_signal.emit()
+        super(ProgressBar, self).reject()
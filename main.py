@@ -7,6 +7,7 @@
 
 from common_import import *
 from functools import partial
+import multiprocessing
 import sys
 import time
 
@@ -16,6 +17,7 @@ from ui_MainWindow import  Ui_MainWindow
 from canvas import Canvas
 from datatypes import *
 from widgets import *
+from threads import AnnotationAutosaver
 from utils import *
 
 from typing import *
@@ -42,8 +44,14 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.setupUi(self)
         '''注册和分发WidgetAction'''
         self.raw_image = np.ndarray(0, dtype=int)
+        # 尚未应用到raw_image上的rescale slope与intercept,在窗位窗宽映射时应用
+        self.raw_slope = 1
+        self.raw_intercept = 0
         self.current_series = None
         self.current_file = ''
+        # 标记的读取与后台保存,切换切片时不等待写入
+        self.annotation_autosaver = AnnotationAutosaver(parent=self)
+        self.annotation_autosaver.error_signal.connect(lambda message: QMessageBox.warning(self, '保存标记出错', message))
         self.current_file_wl = 0
         self.current_file_ww = 0
 
@@ -110,7 +118,13 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     def coupling_database_tree_widget(self):
         self.new_database_action.triggered.connect(self.new_database_slot)
         self.open_database_action.triggered.connect(self.open_database_slot)
+        # 同步数据库的action不在ui文件中,在这里注册并分发到数据库菜单
+        self.sync_database_action = newAction(self, '同步数据库', self.sync_database_slot, 'Ctrl+Shift+R',
+                                              tip='重新扫描数据库目录,只读取新增或变化的文件')
+        self.sync_database_action.setObjectName('sync_database_action')
+        self.menu.addAction(self.sync_database_action)
         self.database_widget.series_selected_signal.connect(self.change_series_slot)
+        self.database_widget.import_finished_signal.connect(self.import_finished_slot)
         # 之前初始化database_widget时,尚未绑定,也无从接收
         self.database_widget.send_latest_modified_series()
 
@@ -160,6 +174,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         # 撤销
         self.canvas_undo_action.triggered.connect(self.canvas_undo_slot)
+        # 重做的action不在ui文件中,在这里注册并分发到编辑菜单
+        self.canvas_redo_action = newAction(self, '重做', self.canvas_redo_slot, 'Ctrl+Y',
+                                            tip='重做被撤销的标记操作')
+        self.canvas_redo_action.setObjectName('canvas_redo_action')
+        self.menuEdit.addAction(self.canvas_redo_action)
         # 复制选中的标记
         self.copy_selected_annotations_action.triggered.connect(
             self.canvas_widget.copy_selected_annotations)
@@ -230,20 +249,18 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if file_item:
             self.save_current_work()
             self.current_file = file_item.text()
-            self.current_file_wl, self.current_file_ww, dicom_array = get_dicom_info(self.current_file)
-            self.raw_image = dicom_array.copy()
+            # 切片由slice_cache缓存,返回的数组是只读的,可以直接使用而不需要复制
+            self.current_file_wl, self.current_file_ww, self.raw_image, self.raw_slope, self.raw_intercept = \
+                get_dicom_info(self.current_file)
             if (self.wlww_widget.wl_spin.value() == 0) and (self.wlww_widget.ww_spin.value() == 0):
-                self.wlww_widget.wl_spin.setValue(self.current_file_wl)
-                self.wlww_widget.ww_spin.setValue(self.current_file_ww)
+                self.wlww_widget.set_wlww(self.current_file_wl, self.current_file_ww)
             else:
                 self.wlww_action_slot()
-            annotations_file = self.current_file.replace('.dcm', '.pkl')
-            # 读取标签文件
-            if osp.exists(annotations_file):
-                with open(annotations_file, 'rb') as annotations_pkl:
-                    annotations = pickle.load(annotations_pkl)
+            # 从序列的标记容器中读取当前切片的标记,尚未写入的标记以保存时的快照为准
+            annotations = self.annotation_autosaver.load(*self.locate_annotations(self.current_file),
+                                                         dicom_path=self.current_file)
+            if annotations:
                 self.canvas_widget.load_annotations(annotations)
-            # 保存当前文件
 
     def scroll_request_slot(self, delta: int, orientation: int):
         '''响应canvas的滚动请求'''
@@ -316,19 +333,20 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def wlww_reset_slot(self):
         print('reset')
-        self.wlww_widget.wl_spin.setValue(self.current_file_wl)
-        self.wlww_widget.ww_spin.setValue(self.current_file_ww)
+        self.wlww_widget.set_wlww(self.current_file_wl, self.current_file_ww)
 
     def wlww_request_slot(self, wl_delta, ww_delta):
-        '''响应canvas的窗位窗宽调整请求'''
-        self.wlww_widget.wl_spin.setValue(self.wlww_widget.wl_spin.value() + wl_delta)
-        self.wlww_widget.ww_spin.setValue(self.wlww_widget.ww_spin.value() + ww_delta)
+        '''响应canvas的窗位窗宽调整请求,快速拖动产生的请求由wlww_widget合并,每帧最多重新生成一次图像'''
+        self.wlww_widget.set_wlww(self.wlww_widget.wl_spin.value() + wl_delta,
+                                  self.wlww_widget.ww_spin.value() + ww_delta)
 
     def wlww_action_slot(self):
         '''窗位窗宽数值变化时触发，按照新的窗位窗位窗宽生成图像，重绘画布'''
-        pixmap = dicom_array2pixmap(
-            self.wlww_widget.wl_spin.value(), self.wlww_widget.ww_spin.value(), self.raw_image)
-        self.canvas_widget.change_pixmap(pixmap)
+        # 渲染结果直接交给canvas绘制,不经过QPixmap,每帧不复制像素数据
+        image = window_level_renderer.render(
+            self.wlww_widget.wl_spin.value(), self.wlww_widget.ww_spin.value(), self.raw_image,
+            self.raw_slope, self.raw_intercept)
+        self.canvas_widget.change_pixmap(image)
         self.fit_window_slot(True)
 
     def toggle_mode_slot(self) -> None:
@@ -369,6 +387,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         else:
             self.canvas_widget.restore_annotations()
 
+    def canvas_redo_slot(self):
+        '''重做被撤销的操作，只在编辑模式下有效'''
+        if not self.canvas_widget.create_mode:
+            self.canvas_widget.redo_annotations()
+
     def label_new_annotation_slot(self, new_annotation: Annotation):
         new_annotation.label = LabelEditDialog.get_label()
         print(new_annotation.label.segmentation)
@@ -404,13 +427,24 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.database_widget.new_database(database_dir, database_name)
 
     def open_database_slot(self):
-        '''从指定.xml文件打开dicom数据库'''
+        '''从指定.xml或.db文件打开dicom数据库'''
         database_path, ok = QFileDialog.getOpenFileName(self, caption='选择要打开的数据库',
                                                        directory=self.DATABASE_PATH,
-                                                       filter='数据库文件(*.xml)')
+                                                       filter='数据库文件(*.xml *.db)')
         if ok:
             self.database_widget.open_database(database_path)
 
+    def sync_database_slot(self):
+        '''增量同步当前数据库,数据库没有记录建库目录时(旧版本建立的数据库),请用户指定目录'''
+        if not self.database_widget.database:
+            return
+        database_dir = self.database_widget.dicom_tree.getroot().get('dir', '')
+        if not database_dir:
+            database_dir = QFileDialog.getExistingDirectory(self, '选择要同步的目录')
+            if not database_dir:
+                return
+        self.database_widget.sync_database(database_dir)
+
     def change_series_slot(self, series_item: QTreeWidgetItem, files: List[str]) -> None:
         '''
         响应变更当前序列的请求,有以下来源
@@ -440,7 +474,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def auto_refresh_current_series_modified_time(self):
         if self.current_series:
-            self.current_series.setText(4, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(float(time.time()))))
+            self.database_widget.touch_series(self.current_series)
 
     '''下面的方法与series_list_widget进行交互'''
     def open_dir_slot(self):
@@ -449,14 +483,12 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if not files_dir:
             return
         files = get_dicom_files_path_from_dir(files_dir)
-        # 数据库被更改后,原先的current_series对应的节点会失效,需要在更改前提取uid,在更改后根据uid映射到新节点
-        current_series_uids = []
-        if self.current_series:
-            current_series_uids = self.database_widget.get_top_down_uid(self.current_series)
+        # 导入在后台进行,完成后由import_finished_slot继续处理
+        # 数据库窗口只对变化的部分进行更新,current_series对应的节点在导入后仍然有效
         self.database_widget.add_to_database(files)
-        if current_series_uids:
-            self.current_series = self.database_widget.get_item_from_top_down_uid(current_series_uids)
 
+    def import_finished_slot(self):
+        '''响应数据库导入完成,打开最新导入的序列'''
         self.database_widget.send_latest_imported_series()
 
     def input_files_slot(self, files):
@@ -466,6 +498,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             2.从open_dir/open_file action输入
         '''
         files = sorted(files)
+        # 打开序列时重新检查一次缓存切片的mtime,翻页时命中缓存不再访问文件系统
+        slice_cache.revalidate()
         self.series_list_widget.refresh_files(files)
         self.series_list_widget.change_current_item_slot(-9999)
         if self.toggle_auto_wlww_action.isChecked():
@@ -478,22 +512,43 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.annotations_list_widget.refresh(self.canvas_widget.annotations)
 
     '''下面的方法实现全局功能'''
+    def locate_annotations(self, fp: str) -> Tuple[str, str]:
+        '''返回dicom文件所属序列的标记容器路径与文件的instance uid'''
+        instance_key = self.database_widget.dicom_tree.path_index.get(fp)
+        if instance_key is not None:
+            series_uid, instance_uid = instance_key[2:]
+        else:
+            header = DicomTree.read_header(fp)
+            series_uid, instance_uid = header[0x0020, 0x000E].value, header[0x0008, 0x0018].value
+        return container_path(fp, series_uid), instance_uid
+
     def save_current_work(self):
-        '''保存当前图像的所有标记为图像同名文件'''
-        if self.current_file and self.annotations_list_widget.annotations:
-            with open(self.current_file.replace('.dcm', '.pkl'), 'wb') as annotations_pkl:
-                pickle.dump(self.canvas_widget.annotations, annotations_pkl)
+        '''将当前图像的所有标记交给后台保存,写入序列的标记容器'''
+        if self.current_file:
+            # 标记被全部删除时也需要记录,否则再次打开时会读到删除之前的标记
+            self.annotation_autosaver.save(*self.locate_annotations(self.current_file),
+                                           self.canvas_widget.annotations)
 
     def closeEvent(self, *args, **kwargs):
         '''退出前事件'''
         super().closeEvent(*args, **kwargs)
+        # 保存当前切片的标记,等待所有尚未写入的标记写入完成
+        self.save_current_work()
+        self.annotation_autosaver.shutdown()
+        self.database_widget.stop_build_thread()
+        self.series_list_widget.prefetcher.shutdown()
         self.auto_refresh_current_series_modified_time()
-        self.database_widget.save_item_states_and_modified_time()
+        # 只写入变化过的序列,退出的时间与数据库的大小无关
+        self.database_widget.stop_persist_thread()
 
 
 
-app = QApplication(sys.argv)
-window = MainWindow()
-window.show()
-sys.exit(app.exec_())
+if __name__ == '__main__':
+    # 建库时使用进程池,在windows(spawn)与打包后的程序中,子进程会重新导入主模块,
+    # 因此程序入口必须由__main__保护,并调用freeze_support
+    multiprocessing.freeze_support()
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    sys.exit(app.exec_())
 
@@ -0,0 +1,64 @@
+'''
+比较建库时两种元数据读取方式的代价
+    1.完整读取: pydicom.dcmread(fp),原先的读取方式,会读取包括像素数据在内的整个文件
+    2.只读文件头: DicomTree.read_header(fp),在像素数据之前停止,只解析需要的标签
+统计读取的字节数与每秒处理的文件数
+
+用法: python playground/benchmark_metadata_read.py <dicom目录> [最多文件数]
+'''
+
+import io
+import os
+import os.path as osp
+import sys
+import time
+
+import pydicom
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+from datatypes import DicomTree
+
+
+class CountingFileIO(io.FileIO):
+    '''记录实际从磁盘读取的字节数'''
+
+    def __init__(self, *args, **kwargs):
+        super(CountingFileIO, self).__init__(*args, **kwargs)
+        self.bytes_read = 0
+
+    def readinto(self, buffer):
+        n = super(CountingFileIO, self).readinto(buffer)
+        self.bytes_read += n or 0
+        return n
+
+
+def benchmark(fps, read_function):
+    bytes_read = 0
+    start = time.perf_counter()
+    for fp in fps:
+        raw = CountingFileIO(fp, 'rb')
+        with io.BufferedReader(raw) as f:
+            DicomTree.get_necessary_meatadata(read_function(f))
+        bytes_read += raw.bytes_read
+    elapsed = time.perf_counter() - start
+    return bytes_read, len(fps) / elapsed
+
+
+if __name__ == '__main__':
+    dicom_dir = sys.argv[1]
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    fps = []
+    for root, dirs, files in os.walk(dicom_dir):
+        fps.extend(osp.join(root, file) for file in files if file.lower().endswith('.dcm'))
+    fps = fps[:limit]
+
+    # 两种方式交替执行一次预热,减小文件系统缓存对先后顺序的影响
+    benchmark(fps[:10], pydicom.dcmread)
+    benchmark(fps[:10], DicomTree.read_header)
+
+    for name, read_function in [('完整读取', pydicom.dcmread),
+                                 ('只读文件头', DicomTree.read_header)]:
+        bytes_read, files_per_second = benchmark(fps, read_function)
+        print('%s: %d个文件, 共读取%.1fMB, 平均每个文件%.1fKB, %.1f文件/秒' % (
+            name, len(fps), bytes_read / 2 ** 20, bytes_read / len(fps) / 2 ** 10,
+            files_per_second))
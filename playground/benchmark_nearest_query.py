@@ -0,0 +1,77 @@
+'''
+比较标记邻近查询的两种实现
+    1.逐点循环: 原先的get_nearest_vertex/get_nearest_edge,对每个顶点调用utils.distance,对每条边调用utils.distancetoline
+    2.向量化: Annotation.get_nearest_vertex/get_nearest_edge,对coords数组进行一次numpy计算
+对不同顶点数的标记,在随机位置上查询,检查两种实现的结果一致,并统计每次查询的耗时
+
+用法: python playground/benchmark_nearest_query.py [查询次数]
+'''
+
+import math
+import os.path as osp
+import random
+import sys
+import time
+
+from PyQt5.QtCore import QPointF
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+import utils
+from datatypes import Annotation
+
+
+def loop_nearest_vertex(annotation, point, epsilon):
+    min_distance = float('inf')
+    min_i = None
+    for i, p in enumerate(annotation.points):
+        dist = utils.distance(p - point)
+        if dist <= epsilon and dist < min_distance:
+            min_distance = dist
+            min_i = i
+    return min_i
+
+
+def loop_nearest_edge(annotation, point, epsilon):
+    min_distance = float('inf')
+    post_i = None
+    for i in range(len(annotation.points)):
+        line = [annotation.points[i - 1], annotation.points[i]]
+        dist = utils.distancetoline(point, line)
+        if dist <= epsilon and dist < min_distance:
+            min_distance = dist
+            post_i = i
+    return post_i
+
+
+def make_annotation(n):
+    '''近似圆形的多边形,类似结节的轮廓标记'''
+    annotation = Annotation()
+    for i in range(n):
+        angle = 2 * math.pi * i / n
+        r = 100 + random.uniform(-5, 5)
+        annotation.addPoint(QPointF(256 + r * math.cos(angle), 256 + r * math.sin(angle)))
+    annotation.close()
+    return annotation
+
+
+def benchmark(query, annotation, points, epsilon):
+    start = time.perf_counter()
+    results = [query(annotation, point, epsilon) for point in points]
+    return results, (time.perf_counter() - start) / len(points)
+
+
+if __name__ == '__main__':
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    random.seed(0)
+    epsilon = 10.0
+    for n in [100, 1000, 5000]:
+        annotation = make_annotation(n)
+        points = [QPointF(random.uniform(140, 372), random.uniform(140, 372)) for _ in range(queries)]
+        for name, loop_query, vectorized_query in [
+                ('顶点', loop_nearest_vertex, Annotation.get_nearest_vertex),
+                ('边', loop_nearest_edge, Annotation.get_nearest_edge)]:
+            loop_results, loop_time = benchmark(loop_query, annotation, points, epsilon)
+            vectorized_results, vectorized_time = benchmark(vectorized_query, annotation, points, epsilon)
+            print('%d个顶点, 最近%s: 逐点循环%.3fms/次, 向量化%.3fms/次, 加速%.1f倍, 结果%s' % (
+                n, name, loop_time * 1000, vectorized_time * 1000, loop_time / vectorized_time,
+                '一致' if loop_results == vectorized_results else '不一致'))
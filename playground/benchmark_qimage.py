@@ -0,0 +1,78 @@
+'''
+比较每帧从uint8数组得到可绘制图像的复制次数与耗时
+    1.PIL: ndarray -> PIL.Image.fromarray -> ImageQt -> QPixmap.fromImage,原先的方式,每一步都复制整帧
+    2.QPixmap: array2qimage -> QPixmap.fromImage,复制一次
+    3.array2qimage: 直接包装为QImage,不复制,由canvas通过drawImage绘制
+复制次数通过比较QImage的像素地址与数组的地址得到,另外统计在窗口大小的设备上绘制一帧的耗时
+
+用法: python playground/benchmark_qimage.py [帧数]
+'''
+
+import os.path as osp
+import sys
+import time
+
+import numpy as np
+from PyQt5.QtGui import QImage, QPixmap, QPainter
+from PyQt5.QtWidgets import QApplication
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+from utils.dicom import array2qimage
+
+
+def pil_convert(array):
+    import PIL.Image, PIL.ImageQt
+    return QPixmap.fromImage(PIL.ImageQt.ImageQt(PIL.Image.fromarray(array)))
+
+
+def pixmap_convert(array):
+    return QPixmap.fromImage(array2qimage(array))
+
+
+def copies(array, image):
+    '''QImage的像素地址与数组相同时没有复制'''
+    return 0 if int(image.constBits()) == array.ctypes.data else 1
+
+
+def benchmark(convert, array, frames):
+    start = time.perf_counter()
+    for _ in range(frames):
+        convert(array)
+    convert_time = (time.perf_counter() - start) / frames
+
+    # 以缩放绘制到一个1280×1024的设备上,模拟canvas的paintEvent
+    device = QImage(1280, 1024, QImage.Format_ARGB32_Premultiplied)
+    image = convert(array)
+    painter = QPainter(device)
+    painter.setRenderHint(QPainter.SmoothPixmapTransform)
+    painter.scale(1024 / array.shape[0], 1024 / array.shape[0])
+    start = time.perf_counter()
+    for _ in range(frames):
+        if isinstance(image, QImage):
+            painter.drawImage(0, 0, image)
+        else:
+            painter.drawPixmap(0, 0, image)
+    paint_time = (time.perf_counter() - start) / frames
+    painter.end()
+    return image, convert_time, paint_time
+
+
+if __name__ == '__main__':
+    app = QApplication(sys.argv)
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rng = np.random.default_rng(0)
+    for size in [512, 1024]:
+        array = rng.integers(0, 256, (size, size), dtype=np.uint8)
+        for name, convert, copy_count in [('PIL', pil_convert, 3),
+                                          ('QPixmap', pixmap_convert, 1),
+                                          ('array2qimage', array2qimage, None)]:
+            try:
+                image, convert_time, paint_time = benchmark(convert, array, frames)
+            except (ImportError, AttributeError) as e:
+                # 新版本的Pillow不再提供ImageQt对PyQt5的支持
+                print('%d×%d %s: 无法运行(%s)' % (size, size, name, e))
+                continue
+            if copy_count is None:
+                copy_count = copies(array, image)
+            print('%d×%d %s: 复制%d次, 转换%.3fms/帧, 绘制%.3fms/帧' % (
+                size, size, name, copy_count, convert_time * 1000, paint_time * 1000))
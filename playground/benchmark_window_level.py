@@ -0,0 +1,55 @@
+'''
+比较两种窗位窗宽渲染方式在交互调窗时的帧率
+    1.原先的方式: np.minimum/np.maximum/np.round逐步生成float64临时数组,再经过PIL.Image与ImageQt转为QPixmap
+    2.WindowLevelRenderer: 每组(wl, ww)计算一次查找表,一次np.take写入复用的uint8缓冲区,直接构造QImage
+模拟ctrl+中键拖动,每帧改变一次窗位窗宽,统计512×512与1024×1024的int16切片每秒能生成的pixmap数
+
+用法: python playground/benchmark_window_level.py [帧数]
+'''
+
+import os.path as osp
+import sys
+import time
+
+import numpy as np
+from PyQt5.QtGui import QPixmap
+from PyQt5.QtWidgets import QApplication
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+from utils.dicom import dicom_array2pixmap
+
+
+def pil_array2pixmap(wl, ww, dicom_array):
+    '''原先的dicom_array2pixmap'''
+    import PIL.Image, PIL.ImageQt
+    dicom_array = np.minimum(dicom_array, wl + ww / 2)
+    dicom_array = np.maximum(dicom_array, wl - ww / 2)
+    dicom_array = np.round(((dicom_array - (wl - ww / 2)) * 255 / ww))
+    dicom_image = PIL.Image.fromarray(dicom_array)
+    dicom_image = dicom_image.convert('L')
+    image = PIL.ImageQt.ImageQt(dicom_image)
+    return QPixmap.fromImage(image)
+
+
+def benchmark(array2pixmap, dicom_array, frames):
+    start = time.perf_counter()
+    for i in range(frames):
+        array2pixmap(40 + i, 400 + i, dicom_array)
+    return frames / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    app = QApplication(sys.argv)
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    # CT值范围内的随机int16切片
+    rng = np.random.default_rng(0)
+    for size in [512, 1024]:
+        dicom_array = rng.integers(-1024, 3072, (size, size)).astype(np.int16)
+        for name, array2pixmap in [('PIL', pil_array2pixmap), ('查找表', dicom_array2pixmap)]:
+            try:
+                fps = benchmark(array2pixmap, dicom_array, frames)
+            except (ImportError, AttributeError) as e:
+                # 新版本的Pillow不再提供ImageQt对PyQt5的支持
+                print('%d×%d %s: 无法运行(%s)' % (size, size, name, e))
+                continue
+            print('%d×%d %s: %.1f帧/秒' % (size, size, name, fps))
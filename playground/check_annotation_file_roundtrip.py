@@ -0,0 +1,59 @@
+'''
+检查原有的.pkl标记文件经过.ann格式(即标记容器中每张切片的数据)往返后不丢失任何属性
+覆盖LegacyUnpickler允许的全部对象: Annotation, LabelStruct, QPointF, QPoint, QColor,
+以及旧协议的pickle中出现的copyreg._reconstructor与object
+
+用法: python playground/check_annotation_file_roundtrip.py
+'''
+
+import os.path as osp
+import pickle
+import sys
+import tempfile
+
+from PyQt5 import QtCore, QtGui
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+from datatypes import Annotation, LabelStruct, read_legacy_annotations
+from datatypes.annotation_file import ANNOTATION_TYPES, dumps_annotations, loads_annotations
+
+
+def make_annotations():
+    annotations = []
+    for i, annotation_type in enumerate(ANNOTATION_TYPES):
+        annotation = Annotation(annotation_type=annotation_type)
+        # 原有的标记文件中顶点可能是QPoint
+        annotation.points = [QtCore.QPointF(i + 0.5, i + 1.25), QtCore.QPoint(i + 2, i + 3)]
+        annotation.label = LabelStruct(name='结节%d' % i, segmentation=i % 2 == 0)
+        annotation.is_visable = i % 2 == 0
+        annotation.fill = i % 3 == 0
+        if i % 2:
+            annotation.close()
+        # 一部分标记使用类属性中的默认颜色
+        if i % 3 != 2:
+            annotation.line_color = QtGui.QColor(10 * i, 20, 30, 200)
+            annotation.fill_color = QtGui.QColor(40, 50 * i, 60, 64)
+        annotations.append(annotation)
+    return annotations
+
+
+def describe(annotation: Annotation) -> tuple:
+    '''标记需要保存的全部属性，颜色只比较在对象上设置过的'''
+    colors = tuple(annotation.__dict__[name].rgba() if name in annotation.__dict__ else None
+                   for name in ('line_color', 'fill_color'))
+    return (annotation.annotation_type, [(p.x(), p.y()) for p in annotation.points], annotation.label.__dict__,
+            annotation.isClosed(), annotation.is_visable, annotation.fill) + colors
+
+
+if __name__ == '__main__':
+    expected = [describe(annotation) for annotation in make_annotations()]
+    directory = tempfile.mkdtemp()
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        path = osp.join(directory, 'protocol%d.pkl' % protocol)
+        with open(path, 'wb') as f:
+            pickle.dump(make_annotations(), f, protocol)
+        legacy = read_legacy_annotations(path)
+        assert [describe(annotation) for annotation in legacy] == expected, protocol
+        result = loads_annotations(dumps_annotations(legacy))
+        assert [describe(annotation) for annotation in result] == expected, protocol
+    print('原有标记文件的全部属性在.ann格式中往返后保持不变')
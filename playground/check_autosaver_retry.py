@@ -0,0 +1,74 @@
+'''
+检查AnnotationAutosaver在写入失败时不会丢失保存请求
+第一次写入标记容器时抛出异常，失败的快照在读取时仍然可见，并在下一次保存或shutdown时重新写入
+
+用法: python playground/check_autosaver_retry.py
+'''
+
+import os.path as osp
+import sys
+import tempfile
+import time
+
+from PyQt5 import QtCore
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+from datatypes import Annotation, AnnotationContainer
+from threads import AnnotationAutosaver
+
+
+class FlakyContainer(AnnotationContainer):
+    '''第一次写入时抛出异常，模拟网络驱动器暂时不可用'''
+
+    def __init__(self, path: str):
+        super(FlakyContainer, self).__init__(path)
+        self.attempts = 0
+
+    def update(self, annotations_dict):
+        self.attempts += 1
+        if self.attempts == 1:
+            raise OSError('网络驱动器暂时不可用')
+        super(FlakyContainer, self).update(annotations_dict)
+
+
+def make_annotation(x: float) -> Annotation:
+    annotation = Annotation(annotation_type='point')
+    annotation.points = [QtCore.QPointF(x, x)]
+    return annotation
+
+
+def wait_for(condition) -> None:
+    deadline = time.time() + 5
+    while not condition():
+        assert time.time() < deadline, '等待超时'
+        time.sleep(0.01)
+
+
+if __name__ == '__main__':
+    path = osp.join(tempfile.mkdtemp(), 'series.anc')
+    errors = []
+    autosaver = AnnotationAutosaver(delay=0)
+    autosaver.error_signal.connect(errors.append, QtCore.Qt.DirectConnection)
+    container = autosaver.containers[path] = FlakyContainer(path)
+
+    annotations = [make_annotation(1)]
+    autosaver.save(path, '1.1', annotations)
+    wait_for(lambda: errors and not autosaver.writing)
+    assert '1.1' not in AnnotationContainer(path)
+    # 写入失败的标记在读取时仍然可见，再次保存未修改的标记时不会被跳过
+    assert autosaver.load(path, '1.1')[0].points == [QtCore.QPointF(1, 1)]
+    assert autosaver.pending
+
+    # 另一张切片的保存请求唤醒后台线程，同时重试写入失败的快照
+    autosaver.save(path, '1.2', [make_annotation(2)])
+    wait_for(lambda: not autosaver.pending and not autosaver.writing)
+    result = AnnotationContainer(path)
+    assert '1.1' in result and '1.2' in result, sorted(result.index)
+
+    # 退出前写入失败的快照由shutdown重试
+    container.attempts = 0
+    autosaver.save(path, '1.3', [make_annotation(3)])
+    wait_for(lambda: len(errors) == 2 and not autosaver.writing)
+    autosaver.shutdown()
+    assert container.read('1.3')[0].points == [QtCore.QPointF(3, 3)]
+    print('写入失败的保存请求已重新写入')
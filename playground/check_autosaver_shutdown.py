@@ -0,0 +1,51 @@
+'''
+检查AnnotationAutosaver在退出时不会丢失保存请求
+后台线程正在(缓慢地)写入时发出新的保存请求，随即shutdown，新的请求也必须写入标记容器
+
+用法: python playground/check_autosaver_shutdown.py
+'''
+
+import os.path as osp
+import sys
+import tempfile
+import time
+
+from PyQt5 import QtCore
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..'))
+from datatypes import Annotation, AnnotationContainer
+from threads import AnnotationAutosaver
+
+
+class SlowContainer(AnnotationContainer):
+    '''每次写入前等待一段时间，模拟网络驱动器上的慢速写入'''
+
+    WRITE_TIME = 0.5
+
+    def update(self, annotations_dict):
+        time.sleep(self.WRITE_TIME)
+        super(SlowContainer, self).update(annotations_dict)
+
+
+def make_annotation(x: float) -> Annotation:
+    annotation = Annotation(annotation_type='point')
+    annotation.points = [QtCore.QPointF(x, x)]
+    return annotation
+
+
+if __name__ == '__main__':
+    path = osp.join(tempfile.mkdtemp(), 'series.anc')
+    autosaver = AnnotationAutosaver(delay=0)
+    autosaver.containers[path] = SlowContainer(path)
+
+    autosaver.save(path, '1.1', [make_annotation(1)])
+    # 等待后台线程开始写入第一个请求
+    while not autosaver.writing:
+        time.sleep(0.01)
+    autosaver.save(path, '1.2', [make_annotation(2)])
+    autosaver.shutdown()
+
+    container = AnnotationContainer(path)
+    assert '1.1' in container and '1.2' in container, sorted(container.index)
+    assert container.read('1.2')[0].points == [QtCore.QPointF(2, 2)]
+    print('写入期间的保存请求在退出时已写入')
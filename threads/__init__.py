@@ -0,0 +1,3 @@
+from .build_database_thread import BuildDatabaseThread
+from .slice_prefetcher import SlicePrefetcher
+from .annotation_autosaver import AnnotationAutosaver
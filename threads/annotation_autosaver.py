@@ -0,0 +1,144 @@
+'''
+实现标记的后台自动保存，切换切片时只在界面线程中记录标记的快照，序列化与写入都在后台线程中进行
+快照使用Annotation.memento()，未变化的标记直接复用上一次的快照，记录快照几乎没有代价
+与上一次读取或保存时的快照相同(标记未被修改)时不写入，
+写入前等待一小段时间，期间对同一张切片的多次保存只写入最后一次的快照，同一个序列的切片在一次追加中写入
+标记容器的每条记录都带有校验值，写入中途崩溃只会留下读取时被丢弃的不完整记录，见AnnotationContainer
+'''
+
+import threading
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from datatypes import Annotation, AnnotationContainer, find_legacy_annotations, read_legacy_annotations
+
+from typing import Dict, List, Tuple
+
+
+class AnnotationAutosaver(QObject):
+    '''
+    标记的自动保存器
+        delay: 收到第一个保存请求后等待的时间(秒)，期间的请求合并后一起写入
+    保存请求以(标记容器路径, instance uid)为键，尚未写入的快照在读取时优先于容器中的内容
+    '''
+
+    # 报告写入时的错误,由后台线程发出,连接的槽函数在界面线程中执行
+    error_signal = pyqtSignal(str)
+
+    DELAY = 0.5
+
+    def __init__(self, delay: float = None, parent=None):
+        super(AnnotationAutosaver, self).__init__(parent)
+        self.delay = self.DELAY if delay is None else delay
+        self.lock = threading.Lock()
+        # (标记容器路径, instance uid) -> 尚未写入的标记快照
+        self.pending = {}  # type: Dict[Tuple[str, str], tuple]
+        # 正在写入的快照，写入完成之前读取时仍然以它为准
+        self.writing = {}  # type: Dict[Tuple[str, str], tuple]
+        # (标记容器路径, instance uid) -> 最近一次读取或保存时的快照，用于跳过未修改的切片
+        self.snapshots = {}  # type: Dict[Tuple[str, str], tuple]
+        # 标记容器路径 -> 打开的标记容器，读取与写入共用，保证读取时索引包含已写入的记录
+        self.containers = {}  # type: Dict[str, AnnotationContainer]
+        self.wakeup = threading.Event()
+        self.flushing = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='annotation_autosaver', daemon=True)
+        self.thread.start()
+
+    def container(self, path: str) -> AnnotationContainer:
+        with self.lock:
+            container = self.containers.get(path)
+        if container is None:
+            # 在lock之外打开容器，读取文件时不阻塞另一个线程的保存请求
+            container = AnnotationContainer(path)
+            with self.lock:
+                container = self.containers.setdefault(path, container)
+        return container
+
+    def save(self, path: str, uid: str, annotations: List[Annotation]) -> None:
+        '''请求保存一张切片的标记，立即返回'''
+        snapshot = tuple(annotation.memento() for annotation in annotations)
+        # 未修改的标记返回同一个快照，逐个比较对象即可
+        previous = self.snapshots.get((path, uid), ())
+        if len(previous) == len(snapshot) and all(a is b for a, b in zip(previous, snapshot)):
+            return
+        self.snapshots[(path, uid)] = snapshot
+        with self.lock:
+            self.pending[(path, uid)] = snapshot
+        self.wakeup.set()
+
+    def load(self, path: str, uid: str, dicom_path: str = '') -> List[Annotation]:
+        '''
+        读取一张切片的标记，尚未写入的快照优先
+        容器中没有该切片的记录时，读取dicom_path对应的原有标记文件，下一次保存时写入容器
+        '''
+        with self.lock:
+            snapshot = self.pending.get((path, uid), self.writing.get((path, uid)))
+        if snapshot is not None:
+            annotations = self.restore(snapshot)
+        else:
+            container = self.container(path)
+            legacy_path = find_legacy_annotations(dicom_path) if dicom_path and uid not in container.index else ''
+            if legacy_path:
+                # 快照留空，即使没有修改，下一次保存时也会将原有的标记写入容器
+                self.snapshots[(path, uid)] = ()
+                return read_legacy_annotations(legacy_path)
+            annotations = container.read(uid)
+        self.snapshots[(path, uid)] = tuple(annotation.memento() for annotation in annotations)
+        return annotations
+
+    @staticmethod
+    def restore(snapshot: tuple) -> List[Annotation]:
+        '''由快照创建新的标记对象，不会与画布上的标记共享状态'''
+        annotations = []
+        for memento in snapshot:
+            annotation = Annotation()
+            annotation.restore(memento)
+            annotations.append(annotation)
+        return annotations
+
+    def run(self) -> None:
+        while True:
+            self.wakeup.wait()
+            # 等待期间的保存请求会被合并，flush时不再等待
+            self.flushing.wait(self.delay)
+            self.wakeup.clear()
+            succeeded = self.write_pending()
+            # 停止之后仍然写入写入期间新增的保存请求，直到没有尚未写入的快照
+            # 写入失败时不再重试，由shutdown在界面线程中最后重试一次
+            if self.stopped:
+                with self.lock:
+                    if not self.pending or not succeeded:
+                        return
+
+    def write_pending(self) -> bool:
+        '''写入所有尚未写入的快照，写入失败的快照放回pending，返回是否全部写入成功'''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.writing = pending
+        batches = {}
+        for (path, uid), snapshot in pending.items():
+            batches.setdefault(path, {})[uid] = self.restore(snapshot)
+        failed = {}
+        for path, annotations_dict in batches.items():
+            # warning: 后台线程中的异常不会被报告，必须在线程内处理
+            try:
+                self.container(path).update(annotations_dict)
+            except Exception as e:
+                failed.update(((path, uid), pending[(path, uid)]) for uid in annotations_dict)
+                self.error_signal.emit('%s: %s: %s' % (path, type(e).__name__, e))
+        with self.lock:
+            # 写入失败的快照在下一次保存或退出时重试，期间读取时仍然以它为准，写入期间新的保存请求优先
+            for key, snapshot in failed.items():
+                self.pending.setdefault(key, snapshot)
+            self.writing = {}
+        return not failed
+
+    def shutdown(self) -> None:
+        '''写入所有尚未写入的快照并停止后台线程，退出程序前调用'''
+        self.stopped = True
+        self.flushing.set()
+        self.wakeup.set()
+        self.thread.join()
+        # 后台线程结束之后才发出的保存请求在当前线程中写入
+        self.write_pending()
@@ -0,0 +1,105 @@
+'''
+实现建库线程，在后台读取dicom文件的元数据，使导入过程中界面保持响应
+导入到正在显示的DicomTree时，线程只负责读取，读取结果在线程结束后由主线程分批合并到DicomTree并保存；
+    建立尚未显示的新数据库时，合并与保存也在线程中进行
+取消导入时，已读取的部分也能被完整地提交
+'''
+
+import time
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from datatypes import DicomTree
+
+from typing import List, Dict, Tuple
+
+
+class BuildDatabaseThread(QThread):
+    '''
+    建库线程，以下两种输入二选一
+        fps: 要导入的文件列表
+        dir_path: 要递归扫描的目录，扫描也在线程中进行
+            同时给出fingerprints(数据库中已有文件的指纹)时进行增量同步,只读取新增或变化的文件
+    读取结果保存在records中，形式为[(路径, 元数据)]，增量同步时已被删除的文件保存在removed_fps中，
+        线程结束(finished信号)后由主线程取用；被取消的导入保留已读取的部分，被取消的同步两者都为空
+    给出dicom_tree(尚未被任何界面使用的新Dicom树)与database_path时，线程在结束前将读取结果合并到dicom_tree并保存，
+        成功时merged为True
+    '''
+
+    # 报告进度: 已读取的文件数, 文件总数
+    progress_signal = pyqtSignal(int, int)
+    # 报告读取过程中的错误,出错后线程停止读取,已读取的结果仍然有效
+    error_signal = pyqtSignal(str)
+
+    # 两次进度报告之间的最小间隔(秒),避免大量信号拥塞主线程的事件循环
+    PROGRESS_INTERVAL = 0.05
+
+    def __init__(self, fps: List[str] = None, dir_path: str = '', workers: int = None,
+                 fingerprints: Dict[str, Tuple[str, str]] = None,
+                 dicom_tree: DicomTree = None, database_path: str = '', parent=None):
+        super(BuildDatabaseThread, self).__init__(parent)
+        self.fps = fps if fps is not None else []
+        self.dir_path = dir_path
+        self.workers = workers
+        self.fingerprints = fingerprints
+        self.records = []
+        self.removed_fps = []
+        self.dicom_tree = dicom_tree
+        self.database_path = database_path
+        self.merged = False
+        # 读取是否在完成之前被取消
+        self.canceled = False
+
+    @property
+    def is_canceled(self) -> bool:
+        return self.isInterruptionRequested()
+
+    def cancel(self) -> None:
+        '''请求取消,线程会在读取完当前文件后停止'''
+        self.requestInterruption()
+
+    def run(self):
+        if self.dir_path and self.fingerprints is not None:
+            self.fps, self.removed_fps = DicomTree.diff_dir(self.dir_path, self.fingerprints,
+                                                            self.isInterruptionRequested)
+        elif self.dir_path:
+            self.fps = DicomTree.collect_dicom_files(self.dir_path, self.isInterruptionRequested)
+        # 在遍历目录时被取消,遍历的结果不完整,不读取也不删除任何文件
+        if self.dir_path and self.isInterruptionRequested():
+            self.canceled = True
+            self.fps, self.removed_fps = [], []
+        total = len(self.fps)
+        self.progress_signal.emit(0, total)
+
+        metadata_iter = DicomTree.iter_metadata(self.fps, self.workers)
+        last_report_time = time.time()
+        try:
+            for record in metadata_iter:
+                if self.isInterruptionRequested():
+                    self.canceled = True
+                    break
+                self.records.append(record)
+                if time.time() - last_report_time > self.PROGRESS_INTERVAL:
+                    last_report_time = time.time()
+                    self.progress_signal.emit(len(self.records), total)
+        # warning: 在QThread.run中抛出的异常会导致程序退出,必须在线程内处理
+        except Exception as e:
+            self.error_signal.emit('%s: %s' % (type(e).__name__, e))
+        finally:
+            # 关闭迭代器时,进程池中尚未开始的任务会被取消
+            metadata_iter.close()
+        self.progress_signal.emit(len(self.records), total)
+        # 被取消的同步整体放弃,不删除文件也不更新已读取的部分,数据库保持同步之前的状态
+        if self.canceled and self.fingerprints is not None:
+            self.records, self.removed_fps = [], []
+        if self.dicom_tree is not None:
+            self.merge()
+
+    def merge(self) -> None:
+        '''将读取结果合并到新的Dicom树并保存'''
+        try:
+            self.dicom_tree.merge(self.records, self.removed_fps)
+            self.dicom_tree.save(self.database_path)
+            self.merged = True
+        except Exception as e:
+            self.error_signal.emit('%s: %s' % (type(e).__name__, e))
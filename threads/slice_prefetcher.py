@@ -0,0 +1,75 @@
+'''
+实现切片预读器，在浏览序列时于后台线程中提前读取并解码当前切片前后的切片，放入slice_cache
+翻到下一张切片时，其像素数组已经在内存中，不需要等待读取文件
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import get_dicom_info, slice_cache
+
+from typing import List
+
+
+class SlicePrefetcher(object):
+    '''
+    切片预读器
+        depth: 向前和向后各预读的切片数
+        workers: 预读线程数
+    每次预读请求会取消上一次请求中尚未开始且不再需要的任务，快速翻页时不会积压过时的读取
+    '''
+
+    def __init__(self, depth: int = 4, workers: int = 2):
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='slice_prefetcher')
+        # 路径 -> 尚未完成的预读任务
+        self.futures = {}
+
+    def prefetch(self, files: List[str], row: int, direction: int = 1) -> None:
+        '''
+        预读files中第row个切片前后的切片
+        direction为翻页方向(1向后, -1向前)，该方向上的切片优先读取
+        '''
+        if self.depth <= 0 or not 0 <= row < len(files):
+            return
+        direction = 1 if direction >= 0 else -1
+        # 按距离由近到远排列，同样距离时翻页方向上的切片在前
+        rows = []
+        for distance in range(1, self.depth + 1):
+            rows.extend([row + direction * distance, row - direction * distance])
+        paths = [files[i] for i in rows if 0 <= i < len(files)]
+
+        # 取消不在新预读范围内的任务，已经开始的任务无法取消，会继续完成并进入缓存
+        # 任务完成时会在预读线程中将其从futures中移除，因此遍历的是副本
+        for path, future in list(self.futures.items()):
+            if path not in paths and future.cancel():
+                self.futures.pop(path, None)
+        for path in paths:
+            if path in self.futures or path in slice_cache:
+                continue
+            future = self.executor.submit(self.load, path)
+            # 先记录再注册回调，已经完成的任务会在add_done_callback中立即调用回调
+            self.futures[path] = future
+            future.add_done_callback(lambda future, path=path: self.discard(path, future))
+
+    def discard(self, path: str, future) -> None:
+        '''任务完成或被取消时将其从futures中移除，同一路径之后提交的新任务不受影响'''
+        if self.futures.get(path) is future:
+            self.futures.pop(path, None)
+
+    @staticmethod
+    def load(path: str) -> None:
+        # 预读失败(如文件损坏)时忽略，切片被打开时会再次读取并报告错误
+        try:
+            get_dicom_info(path)
+        except Exception:
+            pass
+
+    def cancel(self) -> None:
+        '''取消所有尚未开始的预读任务'''
+        for future in list(self.futures.values()):
+            future.cancel()
+        self.futures.clear()
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self.executor.shutdown(wait=False)
@@ -3,17 +3,170 @@ from common_import import *
 import pydicom
 from pydicom.multival import MultiValue
 import numpy as np
-import PIL.Image, PIL.ImageQt
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class SliceCache(object):
+    '''
+    已解码切片的LRU缓存,以字节数为容量上限
+    以文件路径为键,同时记录文件的mtime,文件被修改后旧的缓存自动失效,即以路径+mtime作为实际的键
+        命中时不是每次都检查mtime(网络路径上每次stat的代价很高),距离上一次检查超过REVALIDATE_INTERVAL,
+        或调用revalidate(如打开一个序列时)之后,才在下一次访问时重新检查
+    在序列中来回翻页时,再次访问的切片不需要读取和解码文件
+    缓存的数组被设为只读,多个使用者共享同一个数组,不需要复制
+    加锁保护,可以在后台线程中使用
+    '''
+
+    # 缓存项的mtime在这一时间(秒)内视为有效
+    REVALIDATE_INTERVAL = 10.0
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # 路径 -> (mtime, 切片信息, 字节数, 上一次检查mtime的时间),按最近使用的顺序排列,最久未使用的在前
+        self._entries = OrderedDict()
+        # 路径 -> 正在读取的线程完成时设置的Event,同一切片被多个线程同时请求时只读取一次
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_mtime(path: str) -> int:
+        return os.stat(path).st_mtime_ns
+
+    def _fresh_entry(self, path: str):
+        '''返回路径的缓存项,上一次检查mtime已超过REVALIDATE_INTERVAL时重新检查,文件已变化时返回None'''
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is None or time.monotonic() - entry[3] < self.REVALIDATE_INTERVAL:
+            return entry
+        try:
+            mtime = self.get_mtime(path)
+        except OSError:
+            return None
+        with self._lock:
+            if self._entries.get(path) is not entry or entry[0] != mtime:
+                return None
+            entry = entry[:3] + (time.monotonic(),)
+            self._entries[path] = entry
+        return entry
+
+    def get(self, path: str):
+        '''返回缓存的切片信息,未命中时返回None'''
+        return self._lookup(path, count=True)
+
+    def _lookup(self, path: str, count: bool):
+        '''count为False时不计入命中统计'''
+        entry = self._fresh_entry(path)
+        with self._lock:
+            if entry is None or path not in self._entries:
+                if count:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+            if count:
+                self.hits += 1
+            return entry[1]
+
+    def revalidate(self) -> None:
+        '''使所有缓存项在下一次访问时重新检查mtime'''
+        with self._lock:
+            for path, entry in list(self._entries.items()):
+                self._entries[path] = entry[:3] + (0.0,)
+
+    def put(self, path: str, mtime: int, info: tuple) -> None:
+        '''加入缓存,超出容量时淘汰最久未使用的切片,单个超出容量的切片不缓存'''
+        nbytes = sum(item.nbytes for item in info if isinstance(item, np.ndarray))
+        with self._lock:
+            old_entry = self._entries.pop(path, None)
+            if old_entry is not None:
+                self.nbytes -= old_entry[2]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[path] = (mtime, info, nbytes, time.monotonic())
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted_nbytes, _) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+    def get_or_load(self, path: str, loader):
+        '''
+        返回缓存的切片信息,未命中时用loader(path)读取并加入缓存
+        若该切片正在被其它线程(如后台预读)读取,则等待其完成,而不是重复读取
+        每次调用只计入一次命中或未命中,等待其它线程读取之后的再次查找不计入
+        '''
+        info = self.get(path)
+        if info is not None:
+            return info
+        while True:
+            with self._lock:
+                loading = self._loading.get(path)
+                if loading is None:
+                    self._loading[path] = threading.Event()
+                    break
+            # 等待完成后重新查找,另一个线程读取失败或切片未被缓存时,由当前线程读取
+            loading.wait()
+            info = self._lookup(path, count=False)
+            if info is not None:
+                return info
+        try:
+            # 在读取之前取得mtime,读取过程中文件被修改时,下一次检查会发现缓存已经过期
+            mtime = self.get_mtime(path)
+            info = loader(path)
+            for item in info:
+                if isinstance(item, np.ndarray):
+                    item.flags.writeable = False
+            self.put(path, mtime, info)
+        finally:
+            with self._lock:
+                loading = self._loading.pop(path, None)
+            if loading is not None:
+                loading.set()
+        return info
+
+    def __contains__(self, path: str) -> bool:
+        '''检查切片是否已被缓存,不计入命中统计'''
+        return self._fresh_entry(path) is not None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0,
+                    'slices': len(self._entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+# 全局的切片缓存,所有读取切片的地方共享
+slice_cache = SliceCache()
+
 
 def get_dicom_info(dicom_path: str):
+    '''
+    返回切片的窗位,窗宽,只读像素数组,以及尚未应用到数组上的rescale slope与intercept,优先从slice_cache中获取
+    显示时由dicom_array2pixmap将slope与intercept合并到窗位窗宽的映射中
+    '''
+    return slice_cache.get_or_load(dicom_path, read_dicom_info)
+
+def read_dicom_info(dicom_path: str):
+    '''读取并解码切片,不经过缓存'''
     dicom_object = pydicom.dcmread(dicom_path)
     dicom_array = dicom_object.pixel_array
+    slope, intercept = 1, 0
     try:
         intercept = dicom_object[0x28, 0x1052].value
         slope = dicom_object[0x28, 0x1053].value
-        dicom_array = (dicom_array * slope) + intercept
     except:
         pass
+    dicom_array, slope, intercept = rescale_integer(dicom_array, slope, intercept)
 
     wl = dicom_object[0x28, 0x1050].value
     if isinstance(wl, MultiValue):
@@ -22,16 +175,128 @@ def get_dicom_info(dicom_path: str):
     if isinstance(ww, MultiValue):
         ww = ww.pop()
 
-    return wl, ww, dicom_array
+    return wl, ww, dicom_array, slope, intercept
+
+def rescale_integer(dicom_array: np.ndarray, slope: float, intercept: float):
+    '''
+    保持像素数组的整数类型,而不是像(dicom_array * slope) + intercept那样转为float64(每个像素8字节)
+        slope与intercept均为整数时(如CT),直接计算CT值,能用int16表示时为int16,否则为int32
+        否则保留原始存储值,将slope与intercept返回给调用者,在窗位窗宽映射时应用
+    返回(像素数组, 剩余的slope, 剩余的intercept)
+    '''
+    if dicom_array.dtype.kind not in 'iu' or float(slope) != int(slope) or float(intercept) != int(intercept):
+        return dicom_array, float(slope), float(intercept)
+    slope, intercept = int(slope), int(intercept)
+    if slope == 1 and intercept == 0:
+        return dicom_array, 1, 0
+    # 由实际像素值的范围确定结果的范围,以选择能容纳结果的最小类型(如uint16存储的12位数据的CT值可用int16表示)
+    bounds = [int(dicom_array.min()) * slope + intercept, int(dicom_array.max()) * slope + intercept] \
+        if dicom_array.size else [intercept]
+    int16_info, int32_info = np.iinfo(np.int16), np.iinfo(np.int32)
+    if not (int32_info.min <= min(bounds) and max(bounds) <= int32_info.max):
+        return dicom_array, float(slope), float(intercept)
+    dtype = np.int16 if int16_info.min <= min(bounds) and max(bounds) <= int16_info.max else np.int32
+    result = dicom_array.astype(np.int32)
+    result *= slope
+    result += intercept
+    return result.astype(dtype, copy=False), 1, 0
+
+def array2qimage(array: np.ndarray) -> QImage:
+    '''
+    将二维uint8数组直接包装为Format_Grayscale8的QImage,不复制像素数据
+    QImage的每行字节数取自数组的行步长,因此不要求宽度按4字节对齐;非C连续的数组(如切片视图)会先复制为连续数组
+    QImage不持有数组的引用,数组被绑定到QImage的ndarray属性上,保证其生命周期不短于QImage
+    注意QImage与数组共享内存,之后对数组的修改会反映到QImage上
+    '''
+    if array.ndim != 2 or array.dtype != np.uint8:
+        raise ValueError('需要二维uint8数组, 实际为%d维%s数组' % (array.ndim, array.dtype))
+    if not array.flags.c_contiguous:
+        array = np.ascontiguousarray(array)
+    height, width = array.shape
+    image = QImage(array.data, width, height, array.strides[0], QImage.Format_Grayscale8)
+    image.ndarray = array
+    return image
+
+class WindowLevelRenderer(object):
+    '''
+    按窗位窗宽将像素数组映射为8位灰度图像
+    对于16位整数数组,为每组(wl, ww)预先计算65536项的查找表,以数组的uint16视图为索引,
+        一次np.take写入复用的uint8缓冲区,调整窗位窗宽时不产生任何浮点临时数组
+    尚未应用到数组上的rescale slope与intercept被合并到映射中,数组可以保持原始存储值
+    其它类型的数组(如浮点)在复用的float32缓冲区中原地计算
+    输出的QImage直接引用uint8缓冲区,不经过PIL,缓冲区在下一次render时被覆盖,需要保留时应复制(如转为QPixmap)
+    '''
+
+    LUT_SIZE = 2 ** 16
+
+    def __init__(self):
+        # 最近一次的查找表及其对应的(wl, ww, dtype, slope, intercept)
+        self._lut = None
+        self._lut_key = None
+        self._buffer = np.empty(0, dtype=np.uint8)
+        self._float_buffer = np.empty(0, dtype=np.float32)
+
+    @staticmethod
+    def window(wl: float, ww: float):
+        '''返回窗口的下界与宽度,窗宽不大于0时按1处理,避免除零'''
+        ww = max(float(ww), 1.0)
+        return wl - ww / 2, ww
+
+    def lut(self, wl: float, ww: float, dtype: np.dtype, slope: float = 1, intercept: float = 0) -> np.ndarray:
+        '''返回16位整数类型dtype在(wl, ww)下的查找表,索引为像素值的uint16视图'''
+        dtype = np.dtype(dtype)
+        key = (wl, ww, dtype, slope, intercept)
+        if key != self._lut_key:
+            values = np.arange(self.LUT_SIZE, dtype=np.int32)
+            if dtype.kind == 'i':
+                # int16的负值在uint16视图中位于后半部分
+                values[self.LUT_SIZE // 2:] -= self.LUT_SIZE
+            if slope != 1 or intercept != 0:
+                values = values * slope + intercept
+            low, ww = self.window(wl, ww)
+            lut = np.clip((values - low) * 255 / ww, 0, 255)
+            self._lut = np.round(lut).astype(np.uint8)
+            self._lut_key = key
+        return self._lut
+
+    def buffer(self, shape: tuple) -> np.ndarray:
+        '''返回复用的uint8输出缓冲区,尺寸变化时重新分配'''
+        size = int(np.prod(shape))
+        if self._buffer.size != size:
+            self._buffer = np.empty(size, dtype=np.uint8)
+        return self._buffer.reshape(shape)
+
+    def render_array(self, wl: float, ww: float, dicom_array: np.ndarray,
+                     slope: float = 1, intercept: float = 0) -> np.ndarray:
+        '''将像素数组映射到复用的uint8缓冲区中并返回该缓冲区'''
+        buffer = self.buffer(dicom_array.shape)
+        if dicom_array.dtype.kind in 'iu' and dicom_array.dtype.itemsize == 2:
+            np.take(self.lut(wl, ww, dicom_array.dtype, slope, intercept), dicom_array.view(np.uint16),
+                    out=buffer, mode='clip')
+        else:
+            if self._float_buffer.size != buffer.size:
+                self._float_buffer = np.empty(buffer.size, dtype=np.float32)
+            scratch = self._float_buffer.reshape(dicom_array.shape)
+            low, ww = self.window(wl, ww)
+            np.multiply(dicom_array, slope, out=scratch, casting='unsafe')
+            np.subtract(scratch, low - intercept, out=scratch)
+            np.multiply(scratch, 255 / ww, out=scratch)
+            np.clip(scratch, 0, 255, out=scratch)
+            np.rint(scratch, out=scratch)
+            buffer[...] = scratch
+        return buffer
+
+    def render(self, wl: float, ww: float, dicom_array: np.ndarray,
+               slope: float = 1, intercept: float = 0) -> QImage:
+        '''返回引用输出缓冲区的QImage'''
+        return array2qimage(self.render_array(wl, ww, dicom_array, slope, intercept))
+
 
-def dicom_array2pixmap(wl: int, ww: int, dicom_array: np.ndarray) -> QPixmap:
+# 全局的窗位窗宽渲染器,查找表与缓冲区在多次调用之间复用
+window_level_renderer = WindowLevelRenderer()
 
-    dicom_array = np.minimum(dicom_array, wl + ww / 2)
-    dicom_array = np.maximum(dicom_array, wl - ww / 2)
-    dicom_array = np.round(((dicom_array - (wl - ww / 2)) * 255 / ww))
-    dicom_image = PIL.Image.fromarray(dicom_array)
-    dicom_image = dicom_image.convert('L')
 
-    image = PIL.ImageQt.ImageQt(dicom_image)
-    pixmap = QPixmap.fromImage(image)
-    return pixmap
\ No newline at end of file
+def dicom_array2pixmap(wl: int, ww: int, dicom_array: np.ndarray,
+                       slope: float = 1, intercept: float = 0) -> QPixmap:
+    '''按窗位窗宽生成图像,QPixmap.fromImage复制了缓冲区,返回的pixmap不受之后的渲染影响'''
+    return QPixmap.fromImage(window_level_renderer.render(wl, ww, dicom_array, slope, intercept))
@@ -4,11 +4,13 @@
 '''
 
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from xml.etree.ElementTree import Element
 
-from datatypes import DicomTree
+from datatypes import DicomTree, DatabaseStore
 from dialogs import *
+from threads import BuildDatabaseThread
 from utils import *
 from typing import *
 
@@ -18,14 +20,47 @@ class DatabaseWidget(QTreeWidget):
 
     PATIENT_MARK, STUDY_MARK, SERIES_MARK = '患者', '检查', '序列'
     DATABASE_PATH = osp.abspath(r'database')
+    # 建库时读取元数据的进程数,None表示使用全部cpu核心
+    IMPORT_WORKERS = None
     series_selected_signal = pyqtSignal(QTreeWidgetItem, list)
+    # 通知add_to_database的导入已经完成并提交
+    import_finished_signal = pyqtSignal()
+    # 导入到当前数据库时,每次事件循环中合并到DicomTree的文件数
+    COMMIT_BATCH_SIZE = 500
+    # 报告后台持久化series属性时的错误,由后台线程发出
+    persist_error_signal = pyqtSignal(str)
+    # 后端不支持单独更新series时,由后台线程发出,在界面线程中保存整个数据库(DicomTree, 数据库文件路径)
+    persist_fallback_signal = pyqtSignal(object, str)
+    # series的属性变化在第一次变化之后的这一时间(毫秒)后写入数据库文件,期间的变化合并写入
+    PERSIST_INTERVAL = 5000
 
 ####初始化####
     def __init__(self, parent=None):
         super(DatabaseWidget, self).__init__(parent)
 
         self.dicom_tree = DicomTree()
+        self.dicom_tree.add_listener(self.dicom_tree_changed)
         self.database = ''
+        # top-down uid元组 -> 已经创建的节点
+        self.items = {}
+        # 正在进行的后台导入,同一时间只允许一个
+        self.build_thread = None
+        # 后台导入结果的提交目标: (DicomTree, 数据库文件路径)
+        self.build_target = None
+        # 正在分批进行的合并,见commit_build_thread
+        self.commit_iter = None
+        self.commit_notify = True
+        self.progress = None
+        # series_key -> 尚未写入数据库文件的属性变化,由persist_timer定时在后台线程中写入
+        self.dirty_series = {}
+        self.persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database_persist')
+        self.persist_future = None
+        self.persist_timer = QTimer(self)
+        self.persist_timer.setSingleShot(True)
+        self.persist_timer.setInterval(self.PERSIST_INTERVAL)
+        self.persist_timer.timeout.connect(self.persist_dirty_series)
+        self.persist_error_signal.connect(lambda message: QMessageBox.warning(self, '保存数据库出错', message))
+        self.persist_fallback_signal.connect(self.save_dicom_tree)
         self.init_content()
 
     def init_content(self):
@@ -40,10 +75,12 @@ class DatabaseWidget(QTreeWidget):
         # TODO: 更好的显示方案
         self.hideColumn(1)
         self.hideColumn(2)
-        # 读取和显示现有数据库
+        # 节点在第一次展开时创建其子节点
+        self.itemExpanded.connect(self.populate_item)
+        # 序列节点的勾选状态(由用户或主窗口改变)同步到DicomTree
+        self.itemChanged.connect(self.series_item_changed)
+        # 读取和显示现有数据库,初始状态下只展开到患者级别,最后编辑的序列会由主窗口展开
         self.init_database()
-        # 初始状态下展开到series级别
-        self.expandToDepth(2)
 
     def init_database(self):
         '''
@@ -52,54 +89,147 @@ class DatabaseWidget(QTreeWidget):
             TODO
             2.从config加载的,上一次的数据库
         '''
-        if os.listdir(self.DATABASE_PATH):
-            database_path = osp.join(self.DATABASE_PATH, os.listdir(self.DATABASE_PATH)[0])
+        # 数据库目录下还有.xml数据库的journal等文件,只打开存储后端支持的文件
+        database_files = [file for file in os.listdir(self.DATABASE_PATH) if DatabaseStore.for_path(file)]
+        if database_files:
+            database_path = osp.join(self.DATABASE_PATH, database_files[0])
             self.open_database(database_path)
 ####初始化完成####
 
     def new_database(self, dir_path: str, database_name: str) -> None:
-        '''在指定目录下递归搜索所有dicom文件，构成DicomTree，加载到数据库窗口并保存'''
+        '''在指定目录下递归搜索所有dicom文件，构成DicomTree，加载到数据库窗口并保存,搜索和读取在后台线程进行'''
         # 检查数据库名称合法性
         if database_name in [osp.splitext(file)[0] for file in os.listdir(self.DATABASE_PATH)]:
             QMessageBox.warning(self, '非法输入', '已经存在同名数据库')
             return
 
-        new_database = DicomTree.load_from_dir(dir_path, database_name)
+        new_database = DicomTree()
+        new_database._setroot(Element('database', {'name': database_name, 'dir': dir_path}))
         new_database_path = osp.join(self.DATABASE_PATH, '%s.xml'%(database_name))
-        new_database.write(new_database_path, encoding='utf-8',xml_declaration=True)
-        self.database = new_database_path
-        self.dicom_tree = new_database
-
-        self.refresh()
-        self.expandToDepth(2)
+        # 新数据库在显示之前不被界面访问,合并与保存都在线程中进行
+        self.start_build_thread(BuildDatabaseThread(dir_path=dir_path, workers=self.IMPORT_WORKERS,
+                                                    dicom_tree=new_database, database_path=new_database_path),
+                                new_database, new_database_path)
 
     def open_database(self, database_path: str) -> None:
+        # 重新打开同一个数据库时,读取之前需要先写入尚未持久化的变化
+        self.persist_dirty_series(wait=True)
+        self.set_dicom_tree(DicomTree.load(database_path))
         self.database = database_path
-        self.dicom_tree = DicomTree.load(self.database)
         self.refresh()
 
+    def set_dicom_tree(self, dicom_tree: DicomTree) -> None:
+        '''更换显示的DicomTree,并监听其变化事件,原DicomTree尚未持久化的变化写入self.database'''
+        self.persist_dirty_series()
+        self.dicom_tree.remove_listener(self.dicom_tree_changed)
+        self.dicom_tree = dicom_tree
+        self.dicom_tree.add_listener(self.dicom_tree_changed)
+
     def add_to_database(self, fps: list) -> None:
-        '''将.dcm文件加入dicom数据库,过程中显示分析进度条,结束后打开最新的序列'''
-        progress = ProgressBar(0, len(fps))
-        progress.show()
-        # self.dicom_tree.add_files(fps)
-        for i, fp in enumerate(fps):
-            self.dicom_tree.add_file(fp)
-            progress.setValue(i + 1)
-            QApplication.processEvents()
+        '''将.dcm文件加入dicom数据库,过程中显示分析进度条,读取在后台线程进行,完成后发出import_finished_signal'''
+        fps = [fp for fp in fps if fp.endswith('.dcm')]
+        self.start_build_thread(BuildDatabaseThread(fps=fps, workers=self.IMPORT_WORKERS),
+                                self.dicom_tree, self.database)
 
+    def sync_database(self, dir_path: str = '') -> None:
+        '''
+        增量同步:重新扫描数据库目录(缺省为建库时的目录),只读取新增或变化的文件,并删除已不存在的文件
+        文件是否变化根据数据库中记录的文件指纹(大小,修改时间)判断
+        '''
+        dir_path = dir_path or self.dicom_tree.getroot().get('dir', '')
+        if not dir_path:
+            return
+        self.dicom_tree.getroot().set('dir', dir_path)
+        self.start_build_thread(BuildDatabaseThread(dir_path=dir_path, workers=self.IMPORT_WORKERS,
+                                                    fingerprints=self.dicom_tree.fingerprints()),
+                                self.dicom_tree, self.database)
+
+    def start_build_thread(self, build_thread: BuildDatabaseThread,
+                           dicom_tree: DicomTree, database_path: str) -> None:
+        '''启动后台导入,读取结果在线程结束后提交到dicom_tree,并保存到database_path'''
+        if self.build_thread:
+            QMessageBox.warning(self, '请稍候', '正在导入其它文件')
+            return
+        self.build_thread = build_thread
+        self.build_target = (dicom_tree, database_path)
+        self.progress = ProgressBar(0, len(build_thread.fps))
+        self.progress.show()
+        build_thread.progress_signal.connect(self.progress.setProgress)
+        build_thread.error_signal.connect(lambda message: QMessageBox.warning(self, '导入出错', message))
+        self.progress.canceled_signal.connect(build_thread.cancel)
+        build_thread.finished.connect(self.commit_build_thread)
+        build_thread.start()
+
+    def commit_build_thread(self, notify: bool = True) -> None:
+        '''
+        提交后台导入的结果
+            新数据库已经在线程中合并并保存,直接显示
+            导入到当前数据库时,在事件循环中分批合并到DicomTree,两批之间界面保持响应,全部合并后保存
+        被取消的导入也会提交已经读取的部分,被取消的同步不提交任何变化,不会留下只合并了一半的数据库
+        '''
+        build_thread = self.build_thread
+        if build_thread is None or self.commit_iter is not None:
+            return
+        self.progress.accept()
+        dicom_tree, database_path = self.build_target
+        if build_thread.dicom_tree is not None:
+            self.build_thread = None
+            self.build_target = None
+            # 合并或保存出错时已经通过error_signal报告,保持显示原有的数据库
+            if build_thread.merged:
+                self.set_dicom_tree(dicom_tree)
+                self.database = database_path
+                self.refresh()
+            return
+        # 视图根据DicomTree的变化事件更新,不需要重建
+        self.commit_notify = notify
+        self.commit_iter = dicom_tree.iter_merge(build_thread.records, build_thread.removed_fps,
+                                                 self.COMMIT_BATCH_SIZE)
+        self.commit_next_batch()
+
+    def commit_next_batch(self) -> None:
+        '''合并一批导入结果,尚未全部合并时在下一次事件循环中继续,全部合并后保存数据库'''
+        if self.commit_iter is None:
+            return
+        if next(self.commit_iter, None) is not None:
+            QTimer.singleShot(0, self.commit_next_batch)
+            return
+        dicom_tree, database_path = self.build_target
+        self.commit_iter = None
+        self.build_thread = None
+        self.build_target = None
         # warning 大型数据库保存的时间代价?
-        self.dicom_tree.save(self.database)
-        self.refresh()
+        dicom_tree.save(database_path)
+        if self.commit_notify:
+            self.import_finished_signal.emit()
+
+    def stop_build_thread(self) -> None:
+        '''取消正在进行的后台导入,等待线程结束并提交已读取的部分,用于退出程序前'''
+        if self.build_thread:
+            self.build_thread.cancel()
+            self.build_thread.wait()
+            self.commit_build_thread(notify=False)
+            # 退出前不再等待事件循环,一次合并完剩余的部分
+            if self.commit_iter is not None:
+                self.commit_notify = False
+                for _ in self.commit_iter:
+                    pass
+                self.commit_next_batch()
 
     def refresh(self):
-        '''根据DicomTree的内容刷新显示'''
+        '''
+        根据DicomTree的内容刷新显示
+        只创建患者级的节点,其它节点在其父节点第一次展开时才被创建,见populate_item
+        '''
         self.clear()
+        self.items = {}
         if self.database:
             root_item = QTreeWidgetItem()
             root_item.setText(0, self.dicom_tree.getroot().attrib['name'])
-            self.build_tree_recursively(root_item, self.dicom_tree.getroot())
+            root_item.setData(0, Qt.UserRole, ())
             self.addTopLevelItem(root_item)
+            self.populate_item(root_item)
+            self.expandItem(root_item)
             self.setColumnWidth(0,400)
 
     def expand_recursively(self, item: QTreeWidgetItem):
@@ -112,121 +242,218 @@ class DatabaseWidget(QTreeWidget):
 
     def send_latest_imported_series(self):
         '''将最新导入的序列发送给外部窗口'''
-        latest_time = 0.0
-        latest_series_item = None
-        iter = QTreeWidgetItemIterator(self)
-        while iter.value():
-            item = iter.value()
-            if item.text(3):
-                timestamp = time.mktime(time.strptime(item.text(3), "%Y-%m-%d %H:%M:%S"))
-                if  timestamp > latest_time:
-                    latest_time = timestamp
-                    latest_series_item = item
-            iter.__iadd__(1)
-        self.series_selected_signal.emit(latest_series_item,
-                                         self.get_series_files(latest_series_item))
+        self.send_latest_series('imported_timestamp')
 
     def send_latest_modified_series(self):
         '''将最后编辑的序列发送给外部窗口'''
+        self.send_latest_series('modified_timestamp')
+
+    def send_latest_series(self, timestamp_attribute: str) -> None:
+        '''
+        将某一时间戳最新的序列发送给外部窗口
+        在DicomTree中查找,而不是遍历视图节点,因为序列节点在展开前尚未被创建
+        '''
         latest_time = 0.0
-        latest_series_item = None
-        iter = QTreeWidgetItemIterator(self)
-        while iter.value():
-            item = iter.value()
-            if item.text(4):
-                timestamp = time.mktime(time.strptime(item.text(4), "%Y-%m-%d %H:%M:%S"))
-                if timestamp > latest_time:
-                    latest_time = timestamp
-                    latest_series_item = item
-            iter.__iadd__(1)
-        print(latest_time, latest_series_item, self.get_series_files(latest_series_item))
+        latest_series_uids = None
+        for patient in self.dicom_tree.getroot() if self.database else []:
+            for study in patient:
+                for series in study:
+                    if series.attrib[timestamp_attribute] and \
+                            float(series.attrib[timestamp_attribute]) > latest_time:
+                        latest_time = float(series.attrib[timestamp_attribute])
+                        latest_series_uids = [patient.attrib['id'], study.attrib['uid'], series.attrib['uid']]
+        if latest_series_uids is None:
+            return
+        latest_series_item = self.get_item_from_top_down_uid(latest_series_uids)
         self.series_selected_signal.emit(latest_series_item,
                                          self.get_series_files(latest_series_item))
 
-    def save_item_states_and_modified_time(self):
-        '''保存视图中节点的被标记状态到数据库中元素的被标记状态'''
-        # warning 大型数据库保存的时间代价?
-        iter = QTreeWidgetItemIterator(self)
-        while iter.value():
-            item = iter.value()
-            if self.SERIES_MARK in item.text(0):
-                element = self.item2element(item)
-                element.attrib['annotated'] = str(item.checkState(0))
-                if item.text(4):
-                    element.attrib['modified_timestamp'] = str(time.mktime(time.strptime(item.text(4), "%Y-%m-%d %H:%M:%S")))
-            iter.__iadd__(1)
-        self.dicom_tree.save(self.database)
-
-    def build_tree_recursively(self, tree_widget_item: QTreeWidgetItem, dicom_tree_element: Element):
+    def update_series_attrib(self, key: Tuple[str, str, str], attrib: Dict[str, str]) -> None:
         '''
-        将DicomTree中的内容显示到DatabaseWidget
+        修改一个序列的属性,视图根据变化事件更新
+        数据库文件不立即保存,只记录该序列的变化,由persist_dirty_series在后台线程中写入
+        '''
+        self.dicom_tree.set_series_attrib(key, attrib)
+        self.dirty_series.setdefault(tuple(key), {}).update(attrib)
+        if not self.persist_timer.isActive():
+            self.persist_timer.start()
+
+    def touch_series(self, item: QTreeWidgetItem) -> None:
+        '''将序列的最后编辑时间更新为当前时间'''
+        key = tuple(item.data(0, Qt.UserRole))
+        # 序列可能已经在同步数据库时被删除
+        if key in self.dicom_tree.index:
+            self.update_series_attrib(key, {'modified_timestamp': str(time.time())})
+
+    def series_item_changed(self, item: QTreeWidgetItem, column: int) -> None:
+        '''序列节点的勾选状态变化时,修改DicomTree中序列的被标记状态'''
+        if column != 0 or item.data(0, Qt.CheckStateRole) is None:
+            return
+        key = tuple(item.data(0, Qt.UserRole))
+        element = self.dicom_tree.index.get(key)
+        # 根据DicomTree的变化事件设置勾选状态时,两者已经一致
+        if element is None or element.tag != 'series' or element.get('annotated') == str(item.checkState(0)):
+            return
+        self.update_series_attrib(key, {'annotated': str(item.checkState(0))})
+
+    def persist_dirty_series(self, wait: bool = False) -> None:
+        '''
+        在后台线程中将变化过的序列的属性写入数据库文件,代价只与变化过的序列数量有关,与数据库的大小无关
+        wait为True时等待写入完成
+        '''
+        self.persist_timer.stop()
+        if self.dirty_series and self.database:
+            updates = self.dirty_series
+            self.persist_future = self.persist_executor.submit(self.persist_series, self.dicom_tree,
+                                                               self.database, updates)
+        self.dirty_series = {}
+        if wait and self.persist_future is not None:
+            self.persist_future.result()
+            # 立即执行后台线程请求的整个数据库的保存
+            QCoreApplication.sendPostedEvents(self, QEvent.MetaCall)
+
+    def persist_series(self, dicom_tree: DicomTree, database_path: str,
+                       updates: Dict[Tuple[str, str, str], Dict[str, str]]) -> None:
+        # warning: 后台线程中的异常不会被报告,必须在线程内处理
+        try:
+            # 界面线程会同时修改Dicom树,不能在后台线程中序列化整个数据库
+            if not dicom_tree.persist_series(database_path, updates):
+                self.persist_fallback_signal.emit(dicom_tree, database_path)
+        except Exception as e:
+            self.persist_error_signal.emit('%s: %s' % (type(e).__name__, e))
+
+    # 声明为槽函数,排队的调用以控件本身为接收者,persist_dirty_series等待时可以立即执行
+    @pyqtSlot(object, str)
+    def save_dicom_tree(self, dicom_tree: DicomTree, database_path: str) -> None:
+        '''在界面线程中保存整个数据库,dicom_tree可能是已经被切换掉的数据库'''
+        try:
+            dicom_tree.save(database_path)
+        except Exception as e:
+            self.persist_error_signal.emit('%s: %s' % (type(e).__name__, e))
+
+    def stop_persist_thread(self) -> None:
+        '''写入所有尚未持久化的变化并等待后台线程结束,用于退出程序前'''
+        self.persist_dirty_series(wait=True)
+        self.persist_executor.shutdown(wait=True)
+
+    def populate_item(self, tree_widget_item: QTreeWidgetItem) -> None:
+        '''
+        为一个节点创建其下一级的全部子节点,每个节点只在第一次展开时执行一次
+        这样打开数据库时只需要创建患者级的节点,而不是为成千上万的序列创建节点
+        '''
+        if tree_widget_item.data(0, Qt.UserRole + 1):
+            return
+        tree_widget_item.setData(0, Qt.UserRole + 1, True)
+        parent_key = tuple(tree_widget_item.data(0, Qt.UserRole))
+        parent_element = self.dicom_tree.index[parent_key] if parent_key else self.dicom_tree.getroot()
+        for child_element in list(parent_element):
+            tree_widget_item.addChild(self.create_item(parent_key, child_element))
+
+    def create_item(self, parent_key: tuple, child_element: Element) -> QTreeWidgetItem:
+        '''
+        将DicomTree中的一个元素显示为DatabaseWidget中的一个节点
         这是定义DatabaseWidget的核心方法
             因为DatabaseWidget本质上是显示DicomTree内容的容器,提取和显示哪些属性就决定了DatabaseWidget的定义
         '''
-        if dicom_tree_element.tag == 'series':
+        text_list = []
+        # 提取DicomTree element中的信息构建text_list用于显示(或默认隐藏,条件显示)
+        '''
+        text字段内容如下,除描述信息外,默认隐藏
+            text(0) 描述信息,帮助用户查找和记忆
+            text(1) uid 能够将当前节点唯一对应到DicomTree中元素的uid,默认不显示,帮助程序从view映射到model
+            text(2) 路径
+            text(3) 导入时间 
+            text(4) 最后编辑时间
+        # 
+        '''
+        if child_element.tag == 'patient':
+            text_list = [self.PATIENT_MARK + ': ' + child_element.attrib['id'] + ' ' + child_element.attrib['name'],
+                         child_element.attrib['id'],
+                         '']
+        elif child_element.tag == 'study':
+            text_list = [self.STUDY_MARK + ': ' + child_element.attrib['date'],
+                         child_element.attrib['uid'],
+                         '']
+        elif child_element.tag == 'series':
+            modified_timestamp = ''
+            if child_element.attrib['modified_timestamp']:
+                modified_timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(float(child_element.attrib['modified_timestamp'])))
+            text_list = [self.SERIES_MARK + child_element.attrib['number'] + ': ' + child_element.attrib['description'],
+                         child_element.attrib['uid'],
+                         '',
+                         time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(float(child_element.attrib['imported_timestamp']))),
+                         modified_timestamp]
+            # 对于seires，如果其中instance都来自同一目录，显示目录路径为其文件路径
+            dir = ''
+            for instance in list(child_element):
+                if dir and dir != osp.dirname(instance.attrib['path']):
+                    break
+                dir = osp.dirname(instance.attrib['path'])
+            else:
+                text_list[2] = dir
+
+        # 构建TreeWidget item,由调用者加入到父节点的合适位置
+        child_item = QTreeWidgetItem()
+        child_key = parent_key + (text_list[1],)
+        child_item.setData(0, Qt.UserRole, child_key)
+        self.items[child_key] = child_item
+        # insight: 用默认flags和需要的flag按位异或，就能使需要的flag翻转
+        # 其它级别的item : 自动三态,不可手动标记
+        child_item.setFlags(child_item.flags() ^ Qt.ItemIsAutoTristate)
+        # series级别的item : 可以手动进行三态标记,并且从DicomTree中读取设置状态
+        if child_element.tag == 'series' and osp.exists(text_list[2]):
+            child_item.setCheckState(0, int(child_element.attrib['annotated']))
+        # 其它级别的item : 子节点在展开时才创建,在此之前也要显示展开标志
+        elif child_element.tag != 'series':
+            child_item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+
+        for i in range(len(text_list)):
+            child_item.setText(i, text_list[i])
+        return child_item
+
+    def dicom_tree_changed(self, event: str, key: tuple) -> None:
+        '''
+        响应DicomTree的变化事件,只对受影响的节点进行增加,修改或删除,其它节点(及其选中和展开状态)保持不变
+        子节点尚未创建的父节点不需要处理,其子节点会在展开时根据DicomTree的最新内容创建
+        '''
+        if self.topLevelItem(0) is None:
+            return
+        if event == DicomTree.ELEMENT_REMOVED:
+            if key in self.items:
+                self.remove_item(self.items[key])
             return
-        else:
-            for child_element in list(dicom_tree_element):
-                text_list = []
-                # 提取DicomTree element中的信息构建text_list用于显示(或默认隐藏,条件显示)
-                '''
-                text字段内容如下,除描述信息外,默认隐藏
-                    text(0) 描述信息,帮助用户查找和记忆
-                    text(1) uid 能够将当前节点唯一对应到DicomTree中元素的uid,默认不显示,帮助程序从view映射到model
-                    text(2) 路径
-                    text(3) 导入时间 
-                    text(4) 最后编辑时间
-                # 
-                '''
-                if child_element.tag == 'database':
-                    text_list = [child_element.attrib['name'],
-                                 '',
-                                 '']
-                elif child_element.tag == 'patient':
-                    text_list = [self.PATIENT_MARK + ': ' + child_element.attrib['id'] + ' ' + child_element.attrib['name'],
-                                 child_element.attrib['id'],
-                                 '']
-                elif child_element.tag == 'study':
-                    text_list = [self.STUDY_MARK + ': ' + child_element.attrib['date'],
-                                 child_element.attrib['uid'],
-                                 '']
-                elif child_element.tag == 'series':
-                    modified_timestamp = ''
-                    if child_element.attrib['modified_timestamp']:
-                        modified_timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(float(child_element.attrib['modified_timestamp'])))
-                    text_list = [self.SERIES_MARK + child_element.attrib['number'] + ': ' + child_element.attrib['description'],
-                                 child_element.attrib['uid'],
-                                 '',
-                                 time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(float(child_element.attrib['imported_timestamp']))),
-                                 modified_timestamp]
-                    # 对于seires，如果其中instance都来自同一目录，显示目录路径为其文件路径
-                    dir = ''
-                    for instance in list(child_element):
-                        if dir and dir != osp.dirname(instance.attrib['path']):
-                            print('前后路径', dir, osp.dirname(instance.attrib['path']))
-                            break
-                        dir = osp.dirname(instance.attrib['path'])
-                    else:
-                        text_list[2] = dir
-
-                # 构建TreeWidget item
-                child_item = QTreeWidgetItem(tree_widget_item)
-                # insight: 用默认flags和需要的flag按位异或，就能使需要的flag翻转
-                # 其它级别的item : 自动三态,不可手动标记
-                child_item.setFlags(child_item.flags() ^ Qt.ItemIsAutoTristate)
-                # series级别的item : 可以手动进行三态标记,并且从DicomTree中读取设置状态
-                if child_element.tag == 'series' and osp.exists(text_list[2]):
-                    child_item.setCheckState(0, int(child_element.attrib['annotated']))
-
-                for i in range(len(text_list)):
-                    child_item.setText(i, text_list[i])
-
-                # 递归调用
-                self.build_tree_recursively(child_item, child_element)
-
-                self.resizeColumnToContents(0)
-                self.resizeColumnToContents(1)
-                self.resizeColumnToContents(2)
+
+        element = self.dicom_tree.index[key]
+        # instance不显示为节点,只影响其所在序列显示的目录路径
+        if element.tag == 'instance':
+            series_item = self.items.get(key[:-1])
+            if series_item and series_item.text(2) and \
+                    series_item.text(2) != osp.dirname(element.attrib['path']):
+                series_item.setText(2, '')
+            return
+
+        if event == DicomTree.ELEMENT_ADDED:
+            parent_item = self.items.get(key[:-1]) if len(key) > 1 else self.topLevelItem(0)
+            if parent_item is None or not parent_item.data(0, Qt.UserRole + 1):
+                return
+            parent_element = self.dicom_tree.index[key[:-1]] if len(key) > 1 else self.dicom_tree.getroot()
+            parent_item.insertChild(list(parent_element).index(element), self.create_item(key[:-1], element))
+        elif event == DicomTree.ELEMENT_UPDATED and key in self.items and element.tag == 'series':
+            series_item = self.items[key]
+            if series_item.data(0, Qt.CheckStateRole) is not None:
+                series_item.setCheckState(0, int(element.attrib['annotated']))
+            if element.attrib['modified_timestamp']:
+                series_item.setText(4, time.strftime("%Y-%m-%d %H:%M:%S",
+                                                     time.localtime(float(element.attrib['modified_timestamp']))))
+
+    def remove_item(self, item: QTreeWidgetItem) -> None:
+        '''删除一个节点及其全部子节点'''
+        # 先取下全部子节点再逐个递归,边遍历边删除会跳过一半的子节点
+        for child in item.takeChildren():
+            self.remove_item(child)
+        self.items.pop(tuple(item.data(0, Qt.UserRole)), None)
+        if item.parent():
+            item.parent().removeChild(item)
 
     def mouseDoubleClickEvent(self, ev):
         '''
@@ -261,31 +488,20 @@ class DatabaseWidget(QTreeWidget):
         return [patient_id, study_uid, series_uid]
 
     def get_item_from_top_down_uid(self, uids: List[str]) -> QTreeWidgetItem:
-        '''获取一个top-down uid列表对应的节点'''
+        '''获取一个top-down uid列表对应的节点,沿途尚未创建的节点会被创建'''
         result_item = None
-        if uids:
-            patient_id = uids.pop(0)
-            patient_items = [self.topLevelItem(0).child(i) for i in range(self.topLevelItem(0).childCount())]
-            for patient_item in patient_items:
-                if patient_id == patient_item.text(1):
-                    result_item = patient_item
-                    break
-            if uids:
-                study_uid = uids.pop(0)
-                study_items = [result_item.child(i) for i in
-                                 range(result_item.childCount())]
-                for study_item in study_items:
-                    if study_uid == study_item.text(1):
-                        result_item = study_item
-                        break
-                if uids:
-                    series_uid = uids.pop(0)
-                    series_items = [result_item.child(i) for i in
-                                   range(result_item.childCount())]
-                    for series_item in series_items:
-                        if series_uid == series_item.text(1):
-                            result_item = series_item
-                            break
+        if self.topLevelItem(0) is None:
+            return result_item
+        for depth in range(1, len(uids) + 1):
+            if result_item is None:
+                parent_item = self.topLevelItem(0)
+            else:
+                parent_item = result_item
+            self.populate_item(parent_item)
+            item = self.items.get(tuple(uids[:depth]))
+            if item is None:
+                break
+            result_item = item
         return result_item
 
     def item2element(self, item: QTreeWidgetItem) -> Element:
@@ -4,22 +4,36 @@
 '''
 
 from common_import import *
+from threads import SlicePrefetcher
 
 # 用于支持复合type-hint
 from typing import List
 
 class SeriesListWidget(QListWidget):
+    # 向前和向后各预读的切片数,为0时不预读
+    PREFETCH_DEPTH = 4
+    # 预读线程数
+    PREFETCH_WORKERS = 2
+
     def __init__(self):
         super(SeriesListWidget, self).__init__()
         self.files = []
+        # 上一次的当前行与翻页方向,用于确定优先预读的方向
+        self.last_row = -1
+        self.direction = 1
+        self.prefetcher = SlicePrefetcher(self.PREFETCH_DEPTH, self.PREFETCH_WORKERS)
         self.init_content()
 
     def init_content(self):
 
         self.setSelectionBehavior(QAbstractItemView.SelectItems)
         self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.currentRowChanged.connect(self.prefetch_slot)
 
     def refresh_files(self, files: List[str]) -> None:
+        self.prefetcher.cancel()
+        self.last_row = -1
+        self.direction = 1
         self.clear()
         self.files = files
         self.refresh()
@@ -34,6 +48,15 @@ class SeriesListWidget(QListWidget):
         new_row = min(new_row, self.count() - 1)
         self.setCurrentRow(new_row)
 
+    def prefetch_slot(self, row: int):
+        '''当前行变化时,在后台预读其前后的切片,沿翻页方向优先'''
+        if row < 0:
+            return
+        if self.last_row >= 0 and row != self.last_row:
+            self.direction = 1 if row > self.last_row else -1
+        self.last_row = row
+        self.prefetcher.prefetch(self.files, row, self.direction)
+
 
 
 
@@ -7,8 +7,17 @@ class WlwwWidget(QtWidgets.QWidget):
 
     wlww_changed_signal = QtCore.pyqtSignal(int, int)
 
+    # 两次wlww_changed_signal之间的最小间隔(毫秒),约为一个显示帧
+    RENDER_INTERVAL = 16
+
     def __init__(self):
         super(WlwwWidget,self).__init__()
+        # 合并快速连续的窗位窗宽变化: 空闲时的变化立即通知,此后一个间隔内的变化只在间隔结束时以最新的值通知一次
+        self.render_timer = QtCore.QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(self.RENDER_INTERVAL)
+        self.render_timer.timeout.connect(self.flush)
+        self.pending = False
         self.layout = QtWidgets.QHBoxLayout()
 
         self.wl_lable = QtWidgets.QLabel('窗位')
@@ -34,7 +43,29 @@ class WlwwWidget(QtWidgets.QWidget):
         self.setLayout(self.layout)
 
     def wlww_changed(self):
+        if self.render_timer.isActive():
+            self.pending = True
+            return
         self.wlww_changed_signal.emit(self.wl_spin.value(), self.ww_spin.value())
+        self.render_timer.start()
+
+    def flush(self):
+        '''间隔结束时,若期间有未通知的变化,以最新的值通知一次,并开始下一个间隔'''
+        if self.pending:
+            self.pending = False
+            self.wlww_changed_signal.emit(self.wl_spin.value(), self.ww_spin.value())
+            self.render_timer.start()
+
+    def set_wlww(self, wl: int, ww: int) -> None:
+        '''同时设置窗位窗宽,两个值都改变时也只触发一次变化'''
+        wl, ww = int(wl), int(ww)
+        if wl == self.wl_spin.value() and ww == self.ww_spin.value():
+            return
+        for spin, value in [(self.wl_spin, wl), (self.ww_spin, ww)]:
+            spin.blockSignals(True)
+            spin.setValue(value)
+            spin.blockSignals(False)
+        self.wlww_changed()
 
     def minimumSizeHint(self):
         height = super(WlwwWidget, self).minimumSizeHint().height()